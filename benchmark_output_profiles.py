@@ -0,0 +1,102 @@
+# Standalone script to compare the output profiles in helper/constants.py OUTPUT_PROFILES.
+# It reads a raster (e.g. a clipped tile) once, writes it with every output profile and reports
+# the file size, compression ratio, write time and full/windowed read time for each codec.
+
+# Example usage: python3 benchmark_output_profiles.py --raster=/path/to/proxies-tile-435.tif --work_dir=/tmp/bench
+
+import argparse
+import os
+import time
+import rasterio
+from rasterio.windows import Window
+from helper.constants import OUTPUT_PROFILES
+from helper.io_handler import write_raster_to_file, change_interleave_with_gdal
+
+
+def time_reads(path, win_size):
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        src.read()
+    full_read = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        for row_off in range(0, src.height, win_size):
+            for col_off in range(0, src.width, win_size):
+                win = Window(
+                    col_off,
+                    row_off,
+                    min(win_size, src.width - col_off),
+                    min(win_size, src.height - row_off),
+                )
+                src.read(window=win)
+    window_read = time.perf_counter() - start
+    return full_read, window_read
+
+
+def benchmark_profile(image, profile, output_profile, work_dir, win_size):
+    out_path = os.path.join(work_dir, f"bench-{output_profile}.tif")
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    start = time.perf_counter()
+    write_raster_to_file(image, out_path, profile, output_profile)
+    change_interleave_with_gdal(out_path, output_profile)
+    write_time = time.perf_counter() - start
+    full_read, window_read = time_reads(out_path, win_size)
+    return {
+        "profile": output_profile,
+        "size": os.path.getsize(out_path),
+        "write": write_time,
+        "full_read": full_read,
+        "window_read": window_read,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raster", type=str, required=True, help="Raster to benchmark")
+    parser.add_argument(
+        "--work_dir", type=str, required=True, help="Directory for the benchmark outputs"
+    )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        nargs="+",
+        default=list(OUTPUT_PROFILES),
+        help="Output profiles to compare",
+    )
+    parser.add_argument(
+        "--win_size", type=int, default=512, help="Window size for the windowed reads"
+    )
+    args = parser.parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    with rasterio.open(args.raster) as src:
+        image = src.read()
+        profile = src.profile
+    # Write plain GeoTIFFs so that the "envi" baseline matches what the clipping writes today
+    profile.update(driver="GTiff")
+    raw_size = image.nbytes
+
+    results = [
+        benchmark_profile(image, profile, name, args.work_dir, args.win_size)
+        for name in args.profiles
+    ]
+
+    print(
+        f"{'profile':<10}{'size (MB)':>12}{'ratio':>8}{'write (s)':>12}"
+        f"{'read (s)':>12}{'win read (s)':>14}"
+    )
+    for result in results:
+        print(
+            f"{result['profile']:<10}"
+            f"{result['size'] / 1e6:>12.1f}"
+            f"{raw_size / result['size']:>8.2f}"
+            f"{result['write']:>12.2f}"
+            f"{result['full_read']:>12.2f}"
+            f"{result['window_read']:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,305 @@
-import fiona
-from shapely.geometry import shape
+import contextlib
+import json
 import rasterio
-import geopandas as gpd
 import numpy as np
 import os
-from shapely.geometry import Polygon
+import threading
 from helper.constants import (
-    STUDY_AREA_TILES,
     STRUCTURE_SHORTNAMES,
     FORESTED_POLYGON_CODE,
 )
 from helper.io_handler import (
     find_file,
     write_raster_to_file,
+    open_raster_for_writing,
+    make_output_profile,
+    is_cog_profile,
+    translate_to_cog,
     change_interleave_with_gdal,
     make_tile_dir_if_not_exist,
     make_rasout_names,
     append_bbox_to_filename_if_exists,
 )
+from helper.chunk_cache import get_chunk_cache, read_window
+from helper.envi_reader import open_raster
+from helper.pipeline import run_pipeline
+from helper.tile_index import load_tile_index
 from helper.process_raster import (
     normalize_image,
     normalize_age_image,
+    compute_band_ranges,
+    merge_band_ranges,
+    normalize_image_with_ranges,
 )
 from loguru import logger
 
 
+def find_ntem_path(rasin_dir, rasin_name):
+    if rasin_name in STRUCTURE_SHORTNAMES:
+        ntem_dir = os.path.join(rasin_dir, "structure", rasin_name)
+    else:
+        ntem_dir = os.path.join(rasin_dir, rasin_name)
+    return find_file(ntem_dir, ".dat")
+
+
+# Clip window of a tile on the grid of src, snapped to whole pixels
+def tile_window(src, tile_id, tile_index, bbox=None):
+    win = tile_index.window(tile_id, src)
+
+    if bbox is not None:
+        # Compute a new window based on the bbox
+        # The bbox should be relative to the top left of the first window
+        win = rasterio.windows.Window(
+            win.col_off + bbox[0],
+            win.row_off + bbox[1],
+            bbox[2] - bbox[0],
+            bbox[3] - bbox[1],
+        )
+        logger.info("New window shape: ", win.width, win.height)
+
+    # Snap to whole pixels so that the tile can also be read block by block
+    return rasterio.windows.Window(
+        round(win.col_off), round(win.row_off), round(win.width), round(win.height)
+    )
+
+
+# Window, output paths and profile of a tile, without reading any pixels
+def prepare_tile(src, rasin_name, tile_id, tile_index, out_dir, bbox=None):
+    tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, rasin_name)
+    out_path, out_norm_path = make_rasout_names(tile_dir, rasin_name, tile_id, bbox)
+    profile = src.profile
+    nodata = src.nodatavals
+    win = tile_window(src, tile_id, tile_index, bbox)
+    # Assert nodata are either a tuple of all None or a tuple of equal values
+    assert all(x is None for x in nodata) or len(set(nodata)) == 1
+    nodata = nodata[0]
+    win_transform = src.window_transform(win)
+    profile.update(
+        width=win.width,
+        height=win.height,
+        count=src.count,
+        crs=src.crs,
+        transform=win_transform,
+    )
+    return {
+        "rasin_name": rasin_name,
+        "tile_id": tile_id,
+        "window": win,
+        "nodata": nodata,
+        "profile": profile,
+        "out_path": out_path,
+        "out_norm_path": out_norm_path,
+    }
+
+
+def read_tile(
+    src, rasin_name, tile_id, tile_index, out_dir, bbox=None, chunk_cache=None
+):
+    tile = prepare_tile(src, rasin_name, tile_id, tile_index, out_dir, bbox)
+    tile["image"] = read_window(src, tile["window"], chunk_cache)
+    logger.info("win image shape: ", tile["image"].shape)
+    return tile
+
+
+def row_blocks(win, block_rows):
+    for row in range(0, win.height, block_rows):
+        height = min(block_rows, win.height - row)
+        yield (
+            rasterio.windows.Window(win.col_off, win.row_off + row, win.width, height),
+            rasterio.windows.Window(0, row, win.width, height),
+        )
+
+
+# Clip a tile in blocks of block_rows rows to bound memory. The first pass finds the band ranges
+# of the whole tile, the second normalizes and writes each block, so the output is the same as
+# normalizing the tile at once.
+def clip_tile_in_blocks(src, tile, block_rows, output_profile=None, chunk_cache=None):
+    win = tile["window"]
+    nodata = tile["nodata"]
+    ranges = None
+    for src_block, _ in row_blocks(win, block_rows):
+        block_image = read_window(src, src_block, chunk_cache)
+        block_ranges = compute_band_ranges(block_image, nodata)
+        ranges = merge_band_ranges(ranges, block_ranges)
+
+    norm_profile = tile["profile"].copy()
+    norm_profile.update(dtype=rasterio.uint8, nodata=0)
+    with open_raster_for_writing(
+        tile["out_path"], tile["profile"], output_profile
+    ) as raw_dst, open_raster_for_writing(
+        tile["out_norm_path"], norm_profile, output_profile
+    ) as norm_dst:
+        for src_block, out_block in row_blocks(win, block_rows):
+            block_image = read_window(src, src_block, chunk_cache)
+            raw_dst.write(block_image, window=out_block)
+            norm_block = normalize_image_with_ranges(block_image, nodata, ranges)
+            norm_dst.write(norm_block, window=out_block)
+            write_merged_band(tile, norm_block, window=out_block)
+    # Elaine: you can comment out the line below if you don't need to change the interleave of the raster
+    change_interleave_with_gdal(tile["out_norm_path"], output_profile)
+
+
+# normalize_image works in place, so keep_raw normalizes a copy when the raw window still has to be written.
+# Read-only windows (views of a memory-mapped ENVI source) are always copied.
+def normalize_tile(tile, out_dir, keep_raw=False):
+    image = tile["image"]
+    win_image = image.copy() if keep_raw or not image.flags.writeable else image
+    tile_id = tile["tile_id"]
+    updated_profile = tile["profile"].copy()
+    # Two cases can share the same profile:
+    # Case 1: for BAP, we should not have invalid data (represent the valid range from 1-255)
+    # Case 2: for other rasters, we should have invalid data which we will set to 0
+    updated_profile.update(dtype=rasterio.uint8, nodata=0)
+    # Note: you must have a structure layer to as template to mask out the invalid pixels in age. For some reason,
+    # using VLCE does not produce the same number of invalid pixels as using the structure layer.
+    if tile["rasin_name"] == "age":
+        logger.info("Preprocessing age raster")
+        struct_path = os.path.join(
+            out_dir,
+            f"tile_{tile_id}",
+            "structure",
+            "gross_stem_volume",
+            f"gross_stem_volume-tile-{tile_id}-norm.tif",
+        )
+        logger.info("template path: ", struct_path)
+        norm_win_image = normalize_age_image(
+            win_image,
+            struct_path,
+        )
+    else:
+        norm_win_image = normalize_image(win_image, tile["nodata"])
+    tile["norm_image"] = norm_win_image
+    tile["norm_profile"] = updated_profile
+    return tile
+
+
+def write_raw_tile(tile, output_profile=None):
+    write_raster_to_file(tile["image"], tile["out_path"], tile["profile"], output_profile)
+
+
+def write_norm_tile(tile, output_profile=None):
+    write_raster_to_file(
+        tile["norm_image"], tile["out_norm_path"], tile["norm_profile"], output_profile
+    )
+    write_merged_band(tile, tile["norm_image"])
+    # Elaine: you can comment out the line below if you don't need to change the interleave of the raster
+    change_interleave_with_gdal(tile["out_norm_path"], output_profile)
+
+
 # Clip a single ntem to an AOI. Optially we can specify a bbox in the format of (column_offset, row_offset, width, height)
-def clip_ntems_to_aoi(rasin_name, rasin_path, aoi_path, out_dir, study_area, bbox=None):
-    with fiona.open(aoi_path, "r") as shapefile:
-        for feature in shapefile:
-            tile_id = feature["properties"]["Id"]
-            if tile_id not in STUDY_AREA_TILES[study_area]:
-                continue
-            logger.info("Processing tile: ", tile_id)
-            tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, rasin_name)
-            geometry = feature["geometry"]
-            shapely_geometry = shape(geometry)
-            out_path, out_norm_path = make_rasout_names(
-                tile_dir, rasin_name, tile_id, bbox
+# With pipeline_depth > 0, reading the next tile, normalizing the current one and writing the previous one
+# overlap in separate threads; pipeline_depth tiles at most wait between two stages.
+# With block_rows, tiles taller than block_rows are processed block by block instead (not for age,
+# whose template is read whole) and the pipeline is not used.
+# With chunk_cache_dir, window reads go through an on-disk LRU cache of source blocks capped at chunk_cache_size.
+# With fused_struct_names (see create_merged_structure_rasters), a structure layer is also written into its
+# band of the tile's merged stack.
+def clip_ntems_to_aoi(
+    rasin_name,
+    rasin_path,
+    aoi_path,
+    out_dir,
+    study_area,
+    bbox=None,
+    output_profile=None,
+    tile_ids=None,
+    pipeline_depth=0,
+    block_rows=None,
+    chunk_cache_dir=None,
+    chunk_cache_size=None,
+    fused_struct_names=None,
+):
+    tile_index = load_tile_index(aoi_path)
+    chunk_cache = get_chunk_cache(chunk_cache_dir, chunk_cache_size)
+    target_tiles = tile_index.tile_ids(study_area, tile_ids)
+
+    def add_merged_band(tile):
+        if fused_struct_names and rasin_name in fused_struct_names:
+            merged_path = merged_structure_path(
+                out_dir, tile["tile_id"], fused_struct_names, bbox
             )
-
-            with rasterio.open(rasin_path) as src:
-                profile = src.profile
-                nodata = src.nodatavals
-                bounds = shapely_geometry.bounds
-                win = rasterio.windows.from_bounds(*bounds, transform=src.transform)
-
-                if bbox is not None:
-                    # Compute a new window based on the bbox
-                    # The bbox should be relative to the top left of the first window
-                    win = rasterio.windows.Window(
-                        win.col_off + bbox[0],
-                        win.row_off + bbox[1],
-                        bbox[2] - bbox[0],
-                        bbox[3] - bbox[1],
-                    )
-                    logger.info("New window shape: ", win.width, win.height)
-
-                win_image = src.read(window=win)
-                # Assert nodata are either a tuple of all None or a tuple of equal values
-                assert all(x is None for x in nodata) or len(set(nodata)) == 1
-                nodata = nodata[0]
-                logger.info("win image shape: ", win_image.shape)
-                win_transform = src.window_transform(win)
-                profile.update(
-                    width=win_image.shape[2],
-                    height=win_image.shape[1],
-                    count=win_image.shape[0],
-                    crs=src.crs,
-                    transform=win_transform,
+            tile["merged_path"] = fused_merge_write_path(merged_path, output_profile)
+            tile["merged_band"] = fused_struct_names.index(rasin_name) + 1
+        return tile
+
+    # Raw ENVI sources are memory mapped; anything else goes through rasterio
+    with open_raster(rasin_path) as src:
+        if pipeline_depth and not block_rows:
+
+            def read_stage(tile_id):
+                logger.info(f"Reading tile: {tile_id}")
+                tile = read_tile(
+                    src, rasin_name, tile_id, tile_index, out_dir, bbox, chunk_cache
                 )
-                write_raster_to_file(win_image, out_path, profile)
-                updated_profile = profile.copy()
-                # Two cases can share the same profile:
-                # Case 1: for BAP, we should not have invalid data (represent the valid range from 1-255)
-                # Case 2: for other rasters, we should have invalid data which we will set to 0
-                updated_profile.update(dtype=rasterio.uint8, nodata=0)
-                # Note: you must have a structure layer to as template to mask out the invalid pixels in age. For some reason,
-                # using VLCE does not produce the same number of invalid pixels as using the structure layer.
-                if rasin_name == "age":
-                    logger.info("Preprocessing age raster")
-                    struct_path = os.path.join(
-                        out_dir,
-                        f"tile_{tile_id}",
-                        "structure",
-                        "gross_stem_volume",
-                        f"gross_stem_volume-tile-{tile_id}-norm.tif",
-                    )
-                    logger.info("template path: ", struct_path)
-                    norm_win_image = normalize_age_image(
-                        win_image,
-                        struct_path,
+                # Materialize memory-mapped windows here so the disk I/O happens in the reader thread
+                if not tile["image"].flags.writeable:
+                    tile["image"] = np.array(tile["image"])
+                return add_merged_band(tile)
+
+            def write_stage(tile):
+                write_raw_tile(tile, output_profile)
+                write_norm_tile(tile, output_profile)
+
+            run_pipeline(
+                target_tiles,
+                read_stage,
+                lambda tile: normalize_tile(tile, out_dir, keep_raw=True),
+                write_stage,
+                depth=pipeline_depth,
+            )
+            return
+
+        for tile_id in target_tiles:
+            logger.info("Processing tile: ", tile_id)
+            if block_rows and rasin_name != "age":
+                tile = prepare_tile(src, rasin_name, tile_id, tile_index, out_dir, bbox)
+                add_merged_band(tile)
+                if tile["window"].height > block_rows:
+                    clip_tile_in_blocks(
+                        src, tile, block_rows, output_profile, chunk_cache
                     )
-                else:
-                    norm_win_image = normalize_image(win_image, nodata)
-                write_raster_to_file(norm_win_image, out_norm_path, updated_profile)
-                # Elaine: you can comment out the line below if you don't need to change the interleave of the raster
-                change_interleave_with_gdal(out_norm_path)
+                    continue
+            tile = read_tile(
+                src, rasin_name, tile_id, tile_index, out_dir, bbox, chunk_cache
+            )
+            add_merged_band(tile)
+            write_raw_tile(tile, output_profile)
+            normalize_tile(tile, out_dir)
+            write_norm_tile(tile, output_profile)
 
 
-def stack_rasters_and_write_to_file(struct_paths, merged_path):
+# With block_rows, the layers are stacked block by block so only block_rows rows of every layer are in memory
+def stack_rasters_and_write_to_file(
+    struct_paths, merged_path, output_profile=None, block_rows=None
+):
     raster_datasets = []
-    raster_data = []
 
     try:
-        # Open each raster file, append to the datasets list, and read the data into the data list
+        # Open each raster file and append to the datasets list
         for raster_path in struct_paths:
-            ds = rasterio.open(raster_path)
-            raster_datasets.append(ds)
-            raster_data.append(ds.read())
+            raster_datasets.append(rasterio.open(raster_path))
 
         out_meta = raster_datasets[0].meta.copy()
 
         out_meta.update(count=len(raster_datasets))
 
-        # Write the stacked raster to disk
-        with rasterio.open(merged_path, "w", **out_meta) as dest:
-            for i, data in enumerate(raster_data, start=1):
-                dest.write(np.squeeze(data), i)
-        change_interleave_with_gdal(merged_path)
+        height, width = out_meta["height"], out_meta["width"]
+        if block_rows and height > block_rows:
+            full_window = rasterio.windows.Window(0, 0, width, height)
+            with open_raster_for_writing(merged_path, out_meta, output_profile) as dest:
+                for src_block, out_block in row_blocks(full_window, block_rows):
+                    stacked = np.stack(
+                        [ds.read(1, window=src_block) for ds in raster_datasets], axis=0
+                    )
+                    dest.write(stacked, window=out_block)
+        else:
+            # Write the stacked raster to disk in one call so that compressed, pixel interleaved
+            # blocks are only encoded once
+            stacked = np.stack(
+                [np.squeeze(ds.read()) for ds in raster_datasets], axis=0
+            )
+            write_raster_to_file(stacked, merged_path, out_meta, output_profile)
+        change_interleave_with_gdal(merged_path, output_profile)
         logger.info(f"Stacked structure raster saved at: {merged_path}")
 
     except Exception as e:
@@ -130,43 +311,143 @@ def stack_rasters_and_write_to_file(struct_paths, merged_path):
             raster_dataset.close()
 
 
-def merge_structure_rasters(config):
-    struct_names = []
+def merged_structure_path(out_dir, tile_id, struct_names, bbox=None):
+    merged_path_prefix = "-".join([STRUCTURE_SHORTNAMES[name] for name in struct_names])
+    tile_merged_path = make_tile_dir_if_not_exist(out_dir, tile_id, "merged")
+    return append_bbox_to_filename_if_exists(
+        tile_merged_path + f"{merged_path_prefix}-tile-{tile_id}-norm.tif", bbox
+    )
+
+
+def get_struct_names(config):
+    return [name for name in config["ntems"] if name in STRUCTURE_SHORTNAMES]
+
+
+# Fused merge: rather than re-reading every normalized structure layer once the clips are done, the merged
+# stack of a tile is created empty up front and each clip writes its normalized layer straight into its band.
+# The stack is band interleaved and sparse (SPARSE_OK), so creating it writes no empty blocks and each band
+# write only touches the blocks of that band, once. Use merge_structure_rasters for pixel interleaved stacks.
+# COGs cannot be updated in place, so they are filled as a GeoTIFF and translated by
+# finalize_merged_structure_rasters.
+def fused_merge_write_path(merged_path, output_profile=None):
+    return merged_path + ".tmp.tif" if is_cog_profile(output_profile) else merged_path
+
+
+def create_merged_structure_rasters(config, tile_ids=None):
+    struct_names = get_struct_names(config)
+    bbox = config["bbox"]
+    output_profile = config.get("output_profile")
+    tile_index = load_tile_index(config["aoi_path"])
+    # The structure layers share one grid, so the first gives the window and transform of every tile
+    rasin_path = find_ntem_path(config["rasin_dir"], struct_names[0])
+    with open_raster(rasin_path) as src:
+        for tile_id in tile_index.tile_ids(config["study_area"], tile_ids):
+            win = tile_window(src, tile_id, tile_index, bbox)
+            profile = make_output_profile(
+                {
+                    "driver": "GTiff",
+                    "dtype": rasterio.uint8,
+                    "nodata": 0,
+                    "count": len(struct_names),
+                    "width": win.width,
+                    "height": win.height,
+                    "crs": src.crs,
+                    "transform": src.window_transform(win),
+                },
+                output_profile,
+            )
+            profile.update(interleave="band", sparse_ok=True)
+            merged_path = merged_structure_path(
+                config["out_dir"], tile_id, struct_names, bbox
+            )
+            with rasterio.open(
+                fused_merge_write_path(merged_path, output_profile), "w", **profile
+            ) as dst:
+                for band, name in enumerate(struct_names, start=1):
+                    dst.set_band_description(band, STRUCTURE_SHORTNAMES[name])
+            logger.info(f"Created merged structure raster: {merged_path}")
+
+
+_merged_stack_locks = {}
+_merged_stack_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def merged_stack_lock(merged_path):
+    """Hold an exclusive lock on the merged stack of a tile. Clips of different layers (threads,
+    processes or nodes of the work queue) write bands of the same file, so updates must not overlap.
+    The lock is released by the OS if the holder dies, so a crashed clip cannot block the others."""
+    import fcntl
+
+    # File locks are held per process, so threads of one process also take a lock of their own
+    with _merged_stack_locks_guard:
+        thread_lock = _merged_stack_locks.setdefault(merged_path, threading.Lock())
+    with thread_lock, open(merged_path + ".lock", "a") as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
+def write_merged_band(tile, image, window=None):
+    """Write a normalized single band layer into its band of the fused merged stack, if it has one"""
+    if not tile.get("merged_band"):
+        return
+    with merged_stack_lock(tile["merged_path"]):
+        with rasterio.open(tile["merged_path"], "r+") as dst:
+            dst.write(image[0], tile["merged_band"], window=window)
+
+
+def finalize_merged_structure_rasters(config, tile_ids=None):
+    output_profile = config.get("output_profile")
+    struct_names = get_struct_names(config)
+    tile_index = load_tile_index(config["aoi_path"])
+    for tile_id in tile_index.tile_ids(config["study_area"], tile_ids):
+        merged_path = merged_structure_path(
+            config["out_dir"], tile_id, struct_names, config["bbox"]
+        )
+        write_path = fused_merge_write_path(merged_path, output_profile)
+        # Every band has been written, so the lock of the stack is no longer needed
+        if os.path.exists(write_path + ".lock"):
+            os.remove(write_path + ".lock")
+        if not is_cog_profile(output_profile):
+            continue
+        try:
+            translate_to_cog(write_path, merged_path, output_profile, rasterio.uint8)
+        finally:
+            os.remove(write_path)
+
+
+def merge_structure_rasters(config, tile_ids=None):
+    struct_names = get_struct_names(config)
     bbox = config["bbox"]
-    for rasin_name in config["ntems"]:
-        if rasin_name in STRUCTURE_SHORTNAMES:
-            struct_names.append(rasin_name)
     study_area = config["study_area"]
     aoi_path = config["aoi_path"]
     out_dir = config["out_dir"]
-    with fiona.open(aoi_path, "r") as shapefile:
-        for feature in shapefile:
-            tile_id = feature["properties"]["Id"]
-            if tile_id not in STUDY_AREA_TILES[study_area]:
-                continue
-            logger.info(
-                f"Merging {len(struct_names)} structure layers for tile: {tile_id}"
-            )
-            logger.info(f"Merging the following structure layers: {struct_names}")
-            struct_paths = []
-            for rasin_name in struct_names:
-                tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, rasin_name)
-                struct_path = tile_dir + f"{rasin_name}-tile-{tile_id}-norm.tif"
-                struct_paths.append(
-                    append_bbox_to_filename_if_exists(struct_path, bbox)
-                )
-            # Merge all structure layers into a single raster
-            merged_path_prefix = "-".join(
-                [STRUCTURE_SHORTNAMES[name] for name in struct_names]
-            )
-            tile_merged_path = make_tile_dir_if_not_exist(out_dir, tile_id, "merged")
-            merged_path = append_bbox_to_filename_if_exists(
-                tile_merged_path + f"{merged_path_prefix}-tile-{tile_id}-norm.tif", bbox
-            )
-            stack_rasters_and_write_to_file(struct_paths, merged_path)
+    tile_index = load_tile_index(aoi_path)
+    for tile_id in tile_index.tile_ids(study_area, tile_ids):
+        logger.info(f"Merging {len(struct_names)} structure layers for tile: {tile_id}")
+        logger.info(f"Merging the following structure layers: {struct_names}")
+        struct_paths = []
+        for rasin_name in struct_names:
+            tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, rasin_name)
+            struct_path = tile_dir + f"{rasin_name}-tile-{tile_id}-norm.tif"
+            struct_paths.append(append_bbox_to_filename_if_exists(struct_path, bbox))
+        # Merge all structure layers into a single raster
+        merged_path = merged_structure_path(out_dir, tile_id, struct_names, bbox)
+        stack_rasters_and_write_to_file(
+            struct_paths,
+            merged_path,
+            config.get("output_profile"),
+            config.get("merge_block_rows"),
+        )
 
 
+# geopandas and shapely are only imported by the VRI stages, so clip-only runs do not pay for them
 def filter_forested_polygon_from_vri(vri_path: str, study_area: str):
+    import geopandas as gpd
+
     logger.info(f"Reading VRI data for study area: {study_area}")
     vri = gpd.read_file(vri_path)
     logger.info(f"Original VRI data has {len(vri)} rows")
@@ -186,14 +467,19 @@ def filter_forested_polygon_from_vri(vri_path: str, study_area: str):
     return vri
 
 
-def crop_vri_shapefile(config):
+# vri is the filtered VRI when the caller already loaded it (see process_vri)
+def crop_vri_shapefile(config, tile_ids=None, vri=None):
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
     aoi_path = config["aoi_path"]
     out_dir = config["out_dir"]
     bbox_config = config["bbox"]
     vri_path = config["vri_path"]
     study_area = config["study_area"]
-    vri = filter_forested_polygon_from_vri(vri_path, study_area)
-    aoi = gpd.read_file(aoi_path)
+    if vri is None:
+        vri = filter_forested_polygon_from_vri(vri_path, study_area)
+    tile_index = load_tile_index(aoi_path)
 
     if bbox_config is not None:
         bbox = gpd.GeoDataFrame(
@@ -210,18 +496,17 @@ def crop_vri_shapefile(config):
                 ]
             }
         )
-        bbox.crs = aoi.crs
+        bbox.crs = tile_index.crs
 
-    for _, tile in aoi.iterrows():
-        tile_id = tile["Id"]
-        if tile_id not in STUDY_AREA_TILES[study_area]:
-            continue
+    for tile_id in tile_index.tile_ids(study_area, tile_ids):
         tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, "VRI")
         out_shp_path = append_bbox_to_filename_if_exists(
             tile_dir + f"VRI-tile-{tile_id}.shp", bbox_config
         )
 
-        tile_gdf = gpd.GeoDataFrame([tile.geometry], columns=["geometry"], crs=aoi.crs)
+        tile_gdf = gpd.GeoDataFrame(
+            geometry=[tile_index.geometry(tile_id)], crs=tile_index.crs
+        )
         vri_cropped = gpd.overlay(vri, tile_gdf, how="intersection")
 
         if bbox_config is not None:
@@ -231,14 +516,124 @@ def crop_vri_shapefile(config):
         logger.info(f"Saved cropped VRI to: {out_shp_path}")
 
 
+# Burn the VRI into rasters on the clip grid of each tile, so the labels line up pixel for pixel with the
+# clipped ntems and can be joined to them by array indexing. The grid is taken from the source of
+# config["vri_grid_ntem"] (default: the first ntem of the config), with the same window and bbox as the clip.
+# Every tile gets VRI-id-tile-{tile_id}.tif holding the row of the polygon in the VRI file + 1 (0 outside
+# any polygon), plus one raster per field of config["vri_fields"] (see vri_field_layer).
+def vri_field_layer(column):
+    """(value per polygon, dtype, fill outside polygons, tags) of a VRI attribute. Integer fields stay
+    integers with the largest (unsigned) or smallest (signed) value of the dtype as nodata, so ids are
+    never rounded. Float fields keep their precision with NaN as nodata. Text fields become codes
+    starting at 1 (0 outside polygons and for missing values), with the categories in the tags."""
+    import pandas as pd
+
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        low, high = column.min(), column.max()
+        if pd.isna(low):
+            low = high = 0
+        if low >= 0 and high < np.iinfo(np.uint32).max:
+            dtype, fill = "uint32", np.iinfo(np.uint32).max
+        elif low > np.iinfo(np.int32).min and high <= np.iinfo(np.int32).max:
+            dtype, fill = "int32", np.iinfo(np.int32).min
+        else:
+            # Needs rasterio 1.4 on GDAL 3.5 or newer
+            dtype, fill = "int64", np.iinfo(np.int64).min
+        values = column.astype("Int64").to_numpy(dtype=np.int64, na_value=fill)
+        return values, dtype, fill, None
+    if pd.api.types.is_float_dtype(column):
+        dtype = "float32" if column.dtype == np.float32 else "float64"
+        return column.to_numpy(dtype=dtype, na_value=np.nan), dtype, np.nan, None
+    # Missing values get code -1 + 1 = 0, the same as pixels outside any polygon
+    codes, categories = pd.factorize(column)
+    dtype = "uint16" if len(categories) < np.iinfo(np.uint16).max else "uint32"
+    tags = {"categories": json.dumps([str(c) for c in categories])}
+    return codes + 1, dtype, 0, tags
+
+
+def rasterize_vri_for_tiles(config, tile_ids=None, vri=None):
+    from rasterio.features import rasterize
+    from shapely.geometry import box
+
+    out_dir = config["out_dir"]
+    bbox = config["bbox"]
+    study_area = config["study_area"]
+    grid_ntem = config.get("vri_grid_ntem") or next(iter(config["ntems"]), None)
+    if grid_ntem is None:
+        raise ValueError("Rasterizing the VRI needs vri_grid_ntem or an ntem to take the tile grid from")
+    grid_path = find_ntem_path(config["rasin_dir"], grid_ntem)
+    assert grid_path is not None, f"No .dat found for {grid_ntem}"
+
+    if vri is None:
+        vri = filter_forested_polygon_from_vri(config["vri_path"], study_area)
+    tile_index = load_tile_index(config["aoi_path"])
+
+    # name -> (value per polygon, dtype, fill outside polygons, tags)
+    layers = {"id": (vri.index.to_numpy() + 1, "uint32", 0, None)}
+    for field in config.get("vri_fields") or []:
+        layers[field] = vri_field_layer(vri[field])
+
+    with open_raster(grid_path) as src:
+        for tile_id in tile_index.tile_ids(study_area, tile_ids):
+            logger.info(f"Rasterizing VRI for tile: {tile_id}")
+            win = tile_window(src, tile_id, tile_index, bbox)
+            win_transform = src.window_transform(win)
+            out_shape = (win.height, win.width)
+            # Only burn the polygons intersecting the window, found through the spatial index
+            win_box = box(*rasterio.windows.bounds(win, src.transform))
+            candidates = vri.sindex.query(win_box, predicate="intersects")
+            geometries = vri.geometry.iloc[candidates]
+            tile_dir = make_tile_dir_if_not_exist(out_dir, tile_id, "VRI")
+
+            for name, (values, dtype, fill, tags) in layers.items():
+                if len(candidates):
+                    image = rasterize(
+                        zip(geometries, values[candidates]),
+                        out_shape=out_shape,
+                        transform=win_transform,
+                        fill=fill,
+                        dtype=dtype,
+                    )
+                else:
+                    image = np.full(out_shape, fill, dtype=dtype)
+                profile = {
+                    "driver": "GTiff",
+                    "dtype": dtype,
+                    "count": 1,
+                    "width": win.width,
+                    "height": win.height,
+                    "crs": src.crs,
+                    "transform": win_transform,
+                    "nodata": fill,
+                }
+                out_path = append_bbox_to_filename_if_exists(
+                    tile_dir + f"VRI-{name}-tile-{tile_id}.tif", bbox
+                )
+                write_raster_to_file(
+                    image[np.newaxis],
+                    out_path,
+                    profile,
+                    config.get("output_profile"),
+                    tags,
+                )
+
+
+# The VRI is read and filtered once for cropping and rasterizing
+def process_vri(config, tile_ids=None):
+    vri = filter_forested_polygon_from_vri(config["vri_path"], config["study_area"])
+    crop_vri_shapefile(config, tile_ids, vri)
+    if config.get("rasterize_vri"):
+        rasterize_vri_for_tiles(config, tile_ids, vri)
+
+
 def clip_multiple_ntems_to_aoi(config):
     out_dir = config["out_dir"]
+    struct_names = get_struct_names(config)
+    fused = bool(config["merge_structures"] and config.get("fused_merge") and struct_names)
+    if fused:
+        create_merged_structure_rasters(config)
     for rasin_name in config["ntems"]:
-        if rasin_name in STRUCTURE_SHORTNAMES:
-            rasin_dir = os.path.join(config["rasin_dir"], "structure", rasin_name)
-        else:
-            rasin_dir = os.path.join(config["rasin_dir"], rasin_name)
-        rasin_path = find_file(rasin_dir, ".dat")
+        rasin_path = find_ntem_path(config["rasin_dir"], rasin_name)
         logger.info("Processing raster path: ", rasin_path)
         assert rasin_path is not None
         clip_ntems_to_aoi(
@@ -248,10 +643,21 @@ def clip_multiple_ntems_to_aoi(config):
             out_dir,
             config["study_area"],
             config["bbox"],
+            config.get("output_profile"),
+            # The memory planner turns the pipeline off for layers whose queued tiles exceed the budget
+            pipeline_depth=(config.get("clip_pipeline_depth") or {}).get(
+                rasin_name, config.get("pipeline_depth", 0)
+            ),
+            block_rows=(config.get("clip_block_rows") or {}).get(rasin_name),
+            chunk_cache_dir=config.get("chunk_cache_dir"),
+            chunk_cache_size=config.get("chunk_cache_size"),
+            fused_struct_names=struct_names if fused else None,
         )
 
-    if config["merge_structures"]:
+    if fused:
+        finalize_merged_structure_rasters(config)
+    elif config["merge_structures"]:
         merge_structure_rasters(config)
 
     if config["vri_path"]:
-        crop_vri_shapefile(config)
+        process_vri(config)
@@ -1,6 +1,6 @@
 import os
 import rasterio
-from helper.constants import EXCLUDED_TILES, BC_QUESNEL_MAP
+from helper.constants import BC_QUESNEL_MAP
 from helper.process_raster import normalize_image
 from clip_ntems import stack_rasters_and_write_to_file
 
@@ -55,10 +55,11 @@ def crop_layer_into_smaller_blocks(src_path, bbox_width, bbox_height):
 
 
 # input_dir = "/home/yye/first_project/ntems_2019/bc/processed_tiles/"
-def crop_layers(input_dir, bbox_width, bbox_height):
+# By default only tile 435 of the Quesnel tiles is cropped
+def crop_layers(input_dir, bbox_width, bbox_height, tile_ids=(435,)):
     # Loop through the input directory and each tile
     for tile_id in BC_QUESNEL_MAP:
-        if tile_id != 435:
+        if tile_id not in tile_ids:
             continue
         tile_dir = os.path.join(input_dir, f"tile_{tile_id}")
         proxies_path = os.path.join(tile_dir, "proxies", f"proxies-tile-{tile_id}.tif")
@@ -80,11 +81,11 @@ def crop_layers(input_dir, bbox_width, bbox_height):
 
         crop_layer_into_smaller_blocks(proxies_path, bbox_width, bbox_height)
         crop_layer_into_smaller_blocks(merged_path, bbox_width, bbox_height)
-        break
 
 
-crop_layers(
-    "/home/yye/first_project/ntems_2019/bc/processed_tiles/",
-    1000,
-    1000,
-)
+if __name__ == "__main__":
+    crop_layers(
+        "/home/yye/first_project/ntems_2019/bc/processed_tiles/",
+        1000,
+        1000,
+    )
@@ -12,12 +12,9 @@
 import os
 import numpy as np
 import rasterio
-import geopandas as gpd
-from shapely.geometry import shape
-
-
-def load_study_area(filepath):
-    return gpd.read_file(filepath)
+from helper.io_handler import write_raster_to_file, open_raster_for_writing
+from helper.chunk_cache import get_chunk_cache, read_window
+from helper.tile_index import load_tile_index
 
 
 def get_filepaths(species_dir):
@@ -37,23 +34,26 @@ def normalize_value(x):
 vectorized_normalize = np.vectorize(normalize_value)
 
 
-def crop_and_normalize_raster(filepath, shapely_geometry):
+def crop_and_normalize_raster(filepath, tile_index, tile_id, block=None, chunk_cache=None):
+    """Normalized tile of one species raster. block is an optional window relative to the tile."""
     with rasterio.open(filepath) as src:
-        bounds = shapely_geometry.bounds
-        win = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+        win = tile_index.window(tile_id, src)
         assert win.height == 5000 and win.width == 5000
-        out_image = src.read(window=win)
-        out_image = vectorized_normalize(out_image).astype(np.uint8)
         cropped_transform = src.window_transform(win)
+        if block is not None:
+            win = rasterio.windows.Window(
+                win.col_off + block.col_off,
+                win.row_off + block.row_off,
+                block.width,
+                block.height,
+            )
+        out_image = read_window(src, win, chunk_cache)
+        out_image = vectorized_normalize(out_image).astype(np.uint8)
 
         return out_image[0], cropped_transform
 
 
-def compute_output_bands(data_stack, filepaths):
-    channels, height, width = data_stack.shape
-    assert channels == len(filepaths)
-
-    mean_probs = np.nanmean(data_stack, axis=(1, 2))
+def select_top_species(mean_probs, filepaths):
     non_zero_indices = np.where(mean_probs > 0)[0]
     sorted_indices = np.argsort(mean_probs[non_zero_indices])[::-1]
     top_species_indices = non_zero_indices[
@@ -62,32 +62,44 @@ def compute_output_bands(data_stack, filepaths):
     top_species = [
         os.path.splitext(os.path.basename(filepaths[i]))[0] for i in top_species_indices
     ]
+    return top_species_indices, top_species
+
 
+def compute_output_block(data_stack, top_species_indices):
+    _, height, width = data_stack.shape
     output_bands = np.zeros((6, height, width), dtype=np.float32)
-    for j in range(height):
-        for i in range(width):
-            for band, idx in enumerate(top_species_indices):
-                output_bands[band, j, i] = data_stack[idx, j, i]
-
-            rest_indices = [
-                x for x in range(data_stack.shape[0]) if x not in top_species_indices
-            ]
-            output_bands[5, j, i] = np.sum(data_stack[rest_indices, j, i])
-            assert (
-                0 <= output_bands[5, j, i] <= 255
-            ), f"Value out of range: {output_bands[5, j, i]}"
+    for band, idx in enumerate(top_species_indices):
+        output_bands[band] = data_stack[idx]
+
+    # Sum of the rest of the species = sum of all species - sum of the top species
+    rest_sum = data_stack.sum(axis=0, dtype=np.uint32)
+    for idx in top_species_indices:
+        rest_sum -= data_stack[idx]
+    output_bands[5] = rest_sum
+    assert rest_sum.max(initial=0) <= 255, f"Value out of range: {rest_sum.max()}"
+    return output_bands
+
+
+def compute_output_bands(data_stack, filepaths):
+    channels, height, width = data_stack.shape
+    assert channels == len(filepaths)
+
+    mean_probs = np.nanmean(data_stack, axis=(1, 2))
+    top_species_indices, top_species = select_top_species(mean_probs, filepaths)
+    output_bands = compute_output_block(data_stack, top_species_indices)
 
     return output_bands, top_species
 
 
-def write_output_raster(
-    output_bands, filepaths, top_species, tile_id, cropped_transform, out_dir
+def make_species_profile_and_path(
+    filepaths, tile_id, cropped_transform, height, width, out_dir
 ):
-    profile = rasterio.open(filepaths[0]).profile
+    with rasterio.open(filepaths[0]) as src:
+        profile = src.profile
     profile.update(
         {
-            "height": output_bands.shape[1],
-            "width": output_bands.shape[2],
+            "height": height,
+            "width": width,
             "transform": cropped_transform,
             "count": 6,
         }
@@ -95,40 +107,152 @@ def write_output_raster(
     out_dir = out_dir + f"tile_{tile_id}/species/"
     os.makedirs(out_dir, exist_ok=True)
     out_ras = out_dir + f"species_tile-{tile_id}-norm.tif"
+    return profile, out_ras
 
-    with rasterio.open(out_ras, "w", **profile) as dest:
-        dest.write(output_bands)
-        dest.update_tags(top_species=top_species)
+
+def write_output_raster(
+    output_bands,
+    filepaths,
+    top_species,
+    tile_id,
+    cropped_transform,
+    out_dir,
+    output_profile=None,
+):
+    profile, out_ras = make_species_profile_and_path(
+        filepaths,
+        tile_id,
+        cropped_transform,
+        output_bands.shape[1],
+        output_bands.shape[2],
+        out_dir,
+    )
+    write_raster_to_file(
+        output_bands,
+        out_ras,
+        profile,
+        output_profile,
+        tags={"top_species": top_species},
+    )
 
     print(f"Saved species raster at: {out_ras}")
 
 
-def main():
-    study_area_filepath = "/home/yye/first_project/ntems_2019/nb/nb_study_area.shp"
-    species_dir = "/mnt/e/cfs/2019_CA_forest_tree_species_probabilities/"
-    out_dir = "/home/yye/first_project/ntems_2019/nb/processed_tiles/"
+# Same output as cropping the whole tile, but only block_rows rows of the 37 species are held in
+# memory at a time. The first pass computes the mean probability of every species over the tile to
+# pick the top species, the second pass builds and writes the output block by block.
+def crop_species_tile_in_blocks(
+    filepaths,
+    tile_index,
+    tile_id,
+    out_dir,
+    block_rows,
+    output_profile=None,
+    chunk_cache=None,
+):
+    with rasterio.open(filepaths[0]) as src:
+        win = tile_index.window(tile_id, src)
+    height, width = round(win.height), round(win.width)
+    blocks = [
+        rasterio.windows.Window(0, row, width, min(block_rows, height - row))
+        for row in range(0, height, block_rows)
+    ]
+
+    sums = np.zeros(len(filepaths), dtype=np.float64)
+    for i, filepath in enumerate(filepaths):
+        for block in blocks:
+            out_image, cropped_transform = crop_and_normalize_raster(
+                filepath, tile_index, tile_id, block, chunk_cache
+            )
+            sums[i] += out_image.sum(dtype=np.float64)
+    top_species_indices, top_species = select_top_species(
+        sums / (height * width), filepaths
+    )
+
+    profile, out_ras = make_species_profile_and_path(
+        filepaths, tile_id, cropped_transform, height, width, out_dir
+    )
+    with open_raster_for_writing(out_ras, profile, output_profile) as dest:
+        for block in blocks:
+            data_stack = np.stack(
+                [
+                    crop_and_normalize_raster(
+                        filepath, tile_index, tile_id, block, chunk_cache
+                    )[0]
+                    for filepath in filepaths
+                ],
+                axis=0,
+            )
+            dest.write(compute_output_block(data_stack, top_species_indices), window=block)
+        dest.update_tags(top_species=top_species)
 
-    study_area = load_study_area(study_area_filepath)
+    print(f"Saved species raster at: {out_ras}")
+
+
+def crop_species_for_tiles(
+    study_area_filepath,
+    species_dir,
+    out_dir,
+    tile_ids=None,
+    output_profile=None,
+    block_rows=None,
+    chunk_cache_dir=None,
+    chunk_cache_size=None,
+):
+    tile_index = load_tile_index(study_area_filepath)
+    chunk_cache = get_chunk_cache(chunk_cache_dir, chunk_cache_size)
     filepaths = get_filepaths(species_dir)
+    # Only tiles covered by the species rasters (they all share one grid)
+    covered_tiles = set(tile_index.intersecting_raster(filepaths[0]))
 
-    for index, row in study_area.iterrows():
-        shapely_geometry = shape(row["geometry"])
-        tile_id = row["Id"]
+    for tile_id in tile_index.tile_ids(tile_ids=tile_ids):
+        if tile_id not in covered_tiles:
+            print("Skipping tile outside the species rasters: ", tile_id)
+            continue
         print("Processing tile: ", tile_id)
+        if block_rows:
+            crop_species_tile_in_blocks(
+                filepaths,
+                tile_index,
+                tile_id,
+                out_dir,
+                block_rows,
+                output_profile,
+                chunk_cache,
+            )
+            continue
 
         arrays = []
         for filepath in filepaths:
             out_image, cropped_transform = crop_and_normalize_raster(
-                filepath, shapely_geometry
+                filepath, tile_index, tile_id, chunk_cache=chunk_cache
             )
             arrays.append(out_image)
         data_stack = np.stack(arrays, axis=0)
 
         output_bands, top_species = compute_output_bands(data_stack, filepaths)
         write_output_raster(
-            output_bands, filepaths, top_species, tile_id, cropped_transform, out_dir
+            output_bands,
+            filepaths,
+            top_species,
+            tile_id,
+            cropped_transform,
+            out_dir,
+            output_profile,
         )
 
 
+def main():
+    study_area_filepath = "/home/yye/first_project/ntems_2019/nb/nb_study_area.shp"
+    species_dir = "/mnt/e/cfs/2019_CA_forest_tree_species_probabilities/"
+    out_dir = "/home/yye/first_project/ntems_2019/nb/processed_tiles/"
+    # One of the keys in helper.constants.OUTPUT_PROFILES
+    output_profile = "envi"
+
+    crop_species_for_tiles(
+        study_area_filepath, species_dir, out_dir, output_profile=output_profile
+    )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,154 @@
+# On-disk LRU cache of source raster chunks. Window reads are split into fixed-size blocks keyed on
+# the source identity (path, size, modification time) and the block coordinates. Blocks are stored
+# as .npy files on local disk, so repeated --bbox experiments on the same tiles are served from the
+# cache instead of the large mosaicked sources on network storage. The modification time of a block
+# file is its last use; when the cache grows past its size cap, the least recently used blocks are
+# evicted.
+
+import hashlib
+import os
+import uuid
+import numpy as np
+from rasterio.windows import Window
+
+DEFAULT_BLOCK_SIZE = 1024
+DEFAULT_CACHE_SIZE = "20G"
+# Evict down to this fraction of the cap so that eviction does not run on every write
+EVICT_TO = 0.9
+
+# Caches already opened in this process, keyed on the cache directory
+_caches = {}
+
+
+def source_key(path):
+    stat = os.stat(path)
+    identity = f"{os.path.realpath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+class ChunkCache:
+    def __init__(self, cache_dir, max_bytes, block_size=DEFAULT_BLOCK_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+        self._keys = {}
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def _source_key(self, src):
+        if src.name not in self._keys:
+            self._keys[src.name] = source_key(src.name)
+        return self._keys[src.name]
+
+    def _block_path(self, key, block_row, block_col):
+        # The block size is part of the key so that caches with different block sizes never mix
+        return os.path.join(
+            self.cache_dir, key, f"{self.block_size}-{block_row}-{block_col}.npy"
+        )
+
+    def _read_block(self, src, key, block_row, block_col):
+        path = self._block_path(key, block_row, block_col)
+        try:
+            block = np.load(path)
+            os.utime(path)
+            return block
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, evicted meanwhile or a partial file; read it from the source again
+            pass
+
+        row = block_row * self.block_size
+        col = block_col * self.block_size
+        win = Window(
+            col,
+            row,
+            min(self.block_size, src.width - col),
+            min(self.block_size, src.height - row),
+        )
+        block = np.ascontiguousarray(src.read(window=win))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the target and rename, so readers never see a partial block
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, block)
+        os.replace(tmp_path, path)
+        self.size += block.nbytes
+        if self.size > self.max_bytes:
+            self.evict()
+        return block
+
+    def read(self, src, window):
+        """Read a window of src through the cache, with the same result as src.read(window=window)"""
+        window = Window(
+            round(window.col_off),
+            round(window.row_off),
+            round(window.width),
+            round(window.height),
+        ).intersection(Window(0, 0, src.width, src.height))
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        key = self._source_key(src)
+        out = np.empty(
+            (src.count, row_stop - row_start, col_stop - col_start),
+            dtype=src.profile["dtype"],
+        )
+
+        bs = self.block_size
+        for block_row in range(row_start // bs, (row_stop - 1) // bs + 1):
+            for block_col in range(col_start // bs, (col_stop - 1) // bs + 1):
+                block = self._read_block(src, key, block_row, block_col)
+                # Overlap of the block and the window, in source pixel coordinates
+                r0 = max(row_start, block_row * bs)
+                r1 = min(row_stop, (block_row + 1) * bs)
+                c0 = max(col_start, block_col * bs)
+                c1 = min(col_stop, (block_col + 1) * bs)
+                out_rows = slice(r0 - row_start, r1 - row_start)
+                out_cols = slice(c0 - col_start, c1 - col_start)
+                block_rows = slice(r0 - block_row * bs, r1 - block_row * bs)
+                block_cols = slice(c0 - block_col * bs, c1 - block_col * bs)
+                out[:, out_rows, out_cols] = block[:, block_rows, block_cols]
+        return out
+
+    def evict(self):
+        """Delete least recently used blocks until the cache is below its cap"""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        # Rescan, other processes may share the cache directory
+        self.size = sum(size for _, _, size in entries)
+        target = self.max_bytes * EVICT_TO
+        for path, _, size in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+
+def get_chunk_cache(cache_dir, cache_size=None):
+    """Return the chunk cache of a directory, or None when caching is off (no directory)"""
+    if not cache_dir:
+        return None
+    if cache_dir not in _caches:
+        from helper.planner import parse_memory_size
+
+        max_bytes = parse_memory_size(cache_size or DEFAULT_CACHE_SIZE)
+        _caches[cache_dir] = ChunkCache(cache_dir, max_bytes)
+    return _caches[cache_dir]
+
+
+def read_window(src, window, chunk_cache=None):
+    if chunk_cache is None:
+        return src.read(window=window)
+    return chunk_cache.read(src, window)
@@ -50,3 +50,49 @@ FORESTED_POLYGON_CODE = {
     "ab": {"DENSITY": ["A", "B", "C", "D"]},
     "on": {"POLYTYPE": ["FOR"]},
 }
+
+# Creation options applied on top of the source profile when writing outputs. "envi" keeps the
+# inherited profile untouched (uncompressed, untiled). The predictor is picked from the output
+# dtype at write time (2 for integers, 3 for floats). Profiles with "cog" set are rewritten as
+# Cloud-Optimized GeoTIFFs with internal overviews after the GeoTIFF has been written.
+OUTPUT_PROFILES = {
+    "envi": {},
+    "deflate": {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "zlevel": 6,
+        "num_threads": "ALL_CPUS",
+    },
+    "zstd": {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "zstd",
+        "zstd_level": 9,
+        "num_threads": "ALL_CPUS",
+    },
+    "lzw": {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "lzw",
+        "num_threads": "ALL_CPUS",
+    },
+    "cog": {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "num_threads": "ALL_CPUS",
+        "cog": True,
+        "overview_resampling": "nearest",
+    },
+}
+
+DEFAULT_OUTPUT_PROFILE = "envi"
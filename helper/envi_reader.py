@@ -0,0 +1,210 @@
+# Fast path for reading raw ENVI binaries (.dat + .hdr). The .dat is exposed as a numpy.memmap in
+# its native interleave, so reading a window is a slice of the memory map instead of a trip through
+# the GDAL read stack. Anything the header parser does not understand falls back to rasterio.
+
+import os
+import re
+import numpy as np
+import rasterio
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+# ENVI "data type" codes. Complex types are not supported and fall back to rasterio.
+ENVI_DTYPES = {
+    1: "uint8",
+    2: "int16",
+    3: "int32",
+    4: "float32",
+    5: "float64",
+    12: "uint16",
+    13: "uint32",
+    14: "int64",
+    15: "uint64",
+}
+
+
+class UnsupportedEnviError(Exception):
+    """Raised when an ENVI header cannot be served by the memory-mapped reader"""
+
+
+def find_header(dat_path):
+    base, _ = os.path.splitext(dat_path)
+    for candidate in (base + ".hdr", dat_path + ".hdr"):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def parse_envi_header(hdr_path):
+    with open(hdr_path, "r") as f:
+        text = f.read()
+    if not text.lstrip().startswith("ENVI"):
+        raise UnsupportedEnviError(f"{hdr_path} is not an ENVI header")
+
+    header = {}
+    # Values in braces can span several lines
+    for match in re.finditer(r"^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)", text, re.M):
+        key = match.group(1).strip().lower()
+        value = match.group(2).strip()
+        if value.startswith("{"):
+            value = value[1:-1].strip()
+        header[key] = value
+    return header
+
+
+def split_header_list(value):
+    return [item.strip() for item in value.split(",")]
+
+
+def transform_from_map_info(map_info):
+    # map info = {projection, ref x (1-based), ref y, easting, northing, x size, y size, ...}
+    items = split_header_list(map_info)
+    try:
+        ref_x, ref_y = float(items[1]), float(items[2])
+        easting, northing = float(items[3]), float(items[4])
+        x_size, y_size = float(items[5]), float(items[6])
+    except (IndexError, ValueError):
+        raise UnsupportedEnviError(f"Cannot parse map info: {map_info}")
+    for item in items[7:]:
+        if item.lower().startswith("rotation"):
+            rotation = float(item.split("=")[1])
+            if rotation != 0:
+                raise UnsupportedEnviError("Rotated ENVI grids are not supported")
+    # Convert the (1-based) reference pixel to the upper left corner of the raster
+    left = easting - (ref_x - 1) * x_size
+    top = northing + (ref_y - 1) * y_size
+    return Affine(x_size, 0.0, left, 0.0, -y_size, top)
+
+
+class EnviRaster:
+    """Memory-mapped ENVI raster exposing the subset of the rasterio dataset API used by the clipping"""
+
+    def __init__(self, dat_path, hdr_path):
+        header = parse_envi_header(hdr_path)
+        try:
+            self.width = int(header["samples"])
+            self.height = int(header["lines"])
+            self.count = int(header["bands"])
+            data_type = int(header["data type"])
+        except (KeyError, ValueError):
+            raise UnsupportedEnviError(f"{hdr_path} is missing the raster dimensions")
+        if data_type not in ENVI_DTYPES:
+            raise UnsupportedEnviError(f"Unsupported ENVI data type {data_type}")
+        if header.get("file compression", "0") != "0":
+            raise UnsupportedEnviError("Compressed ENVI files are not supported")
+        interleave = header.get("interleave", "bsq").lower()
+        if interleave not in ("bsq", "bil", "bip"):
+            raise UnsupportedEnviError(f"Unsupported interleave {interleave}")
+        if "map info" not in header:
+            raise UnsupportedEnviError(f"{hdr_path} has no map info")
+
+        self.name = dat_path
+        self.interleave = interleave
+        self.dtype = ENVI_DTYPES[data_type]
+        byte_order = ">" if header.get("byte order", "0") == "1" else "<"
+        file_dtype = np.dtype(self.dtype).newbyteorder(byte_order)
+        offset = int(header.get("header offset", "0"))
+        expected = offset + self.width * self.height * self.count * file_dtype.itemsize
+        if os.path.getsize(dat_path) < expected:
+            raise UnsupportedEnviError(f"{dat_path} is smaller than its header describes")
+
+        self.transform = transform_from_map_info(header["map info"])
+        wkt = header.get("coordinate system string")
+        if not wkt:
+            # GDAL derives the CRS from the projection in map info (e.g. UTM zone and datum); leave that to it
+            raise UnsupportedEnviError(f"{hdr_path} has no coordinate system string")
+        self.crs = CRS.from_wkt(wkt)
+
+        nodata = header.get("data ignore value")
+        self.nodata = float(nodata) if nodata is not None else None
+        if self.nodata is not None and np.dtype(self.dtype).kind in "iu":
+            self.nodata = int(self.nodata)
+        self.nodatavals = tuple([self.nodata] * self.count)
+
+        shapes = {
+            "bsq": (self.count, self.height, self.width),
+            "bil": (self.height, self.count, self.width),
+            "bip": (self.height, self.width, self.count),
+        }
+        # Read-only: windows are views of the page cache, so callers that modify them must copy first
+        # (a copy-on-write map would keep every modified tile resident and leak the changes into later
+        # reads of the same pixels)
+        self._data = np.memmap(
+            dat_path, dtype=file_dtype, mode="r", offset=offset, shape=shapes[interleave]
+        )
+
+    @property
+    def profile(self):
+        return {
+            "driver": "ENVI",
+            "dtype": self.dtype,
+            "nodata": self.nodata,
+            "width": self.width,
+            "height": self.height,
+            "count": self.count,
+            "crs": self.crs,
+            "transform": self.transform,
+            "interleave": {"bsq": "band", "bil": "line", "bip": "pixel"}[
+                self.interleave
+            ],
+        }
+
+    @property
+    def bounds(self):
+        return BoundingBox(
+            *rasterio.transform.array_bounds(self.height, self.width, self.transform)
+        )
+
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
+
+    def read(self, indexes=None, window=None):
+        """Return a read-only (bands, rows, cols) view of the memory map. BIL and BIP sources come
+        back as transposed (non-contiguous) views."""
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        window = window.round_offsets().round_lengths()
+        window = window.intersection(Window(0, 0, self.width, self.height))
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        rows = slice(row_start, row_stop)
+        cols = slice(col_start, col_stop)
+
+        if self.interleave == "bsq":
+            image = self._data[:, rows, cols]
+        elif self.interleave == "bil":
+            image = self._data[rows, :, cols].transpose(1, 0, 2)
+        else:
+            image = self._data[rows, cols, :].transpose(2, 0, 1)
+
+        if not image.dtype.isnative:
+            # Big-endian sources are the one case that needs a copy
+            image = image.astype(self.dtype)
+        if indexes is None:
+            return image
+        if isinstance(indexes, int):
+            return image[indexes - 1]
+        return image[[i - 1 for i in indexes]]
+
+    def close(self):
+        # The mapping is released once the last view handed out by read() is garbage collected;
+        # closing it explicitly would invalidate windows the caller still holds.
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_raster(path):
+    """Open an ENVI .dat through the memory-mapped reader, or fall back to rasterio"""
+    hdr_path = find_header(path)
+    if hdr_path is not None:
+        try:
+            return EnviRaster(path, hdr_path)
+        except (UnsupportedEnviError, ValueError, OSError) as e:
+            print(f"Falling back to rasterio for {path}: {e}")
+    return rasterio.open(path)
@@ -1,9 +1,14 @@
+import contextlib
+import json
 import os
 import subprocess
 import tempfile
-import rasterio
+import uuid
 import helper.constants as constants
 
+# numpy and rasterio are imported inside the functions that need them, so that lightweight users of
+# this module (work queue, tile index cache, CLI) start without loading GDAL.
+
 
 def find_file(target_dir, extension):
     for file in os.listdir(target_dir):
@@ -12,13 +17,120 @@ def find_file(target_dir, extension):
     return None
 
 
-def write_raster_to_file(image, filename, profile):
+def get_output_options(output_profile=None):
+    if output_profile is None:
+        output_profile = constants.DEFAULT_OUTPUT_PROFILE
+    if output_profile not in constants.OUTPUT_PROFILES:
+        raise ValueError(
+            f"Unknown output profile {output_profile}, choose from {list(constants.OUTPUT_PROFILES)}"
+        )
+    return dict(constants.OUTPUT_PROFILES[output_profile])
+
+
+def is_cog_profile(output_profile=None):
+    return get_output_options(output_profile).get("cog", False)
+
+
+def select_predictor(dtype):
+    import numpy as np
+
+    # Horizontal differencing for integers, floating point predictor for floats
+    return 3 if np.dtype(dtype).kind == "f" else 2
+
+
+def make_output_profile(profile, output_profile=None):
+    """Return a copy of the rasterio profile with the creation options of the output profile applied"""
+    options = get_output_options(output_profile)
+    options.pop("cog", None)
+    options.pop("overview_resampling", None)
+    out_profile = dict(profile)
+    if not options:
+        return out_profile
+    out_profile.update(options)
+    # Tiled outputs are written pixel interleaved so that no gdal_translate pass is needed afterwards
+    out_profile["interleave"] = "pixel"
+    if options.get("compress"):
+        out_profile["predictor"] = select_predictor(out_profile["dtype"])
+    return out_profile
+
+
+def translate_to_cog(input_file, output_file, output_profile, dtype):
+    options = get_output_options(output_profile)
+    compress = options.get("compress", "deflate").upper()
+    cmd = [
+        "gdal_translate",
+        "-of",
+        "COG",
+        "-co",
+        f"COMPRESS={compress}",
+        "-co",
+        f"PREDICTOR={select_predictor(dtype)}",
+        "-co",
+        f"BLOCKSIZE={options.get('blockxsize', 512)}",
+        "-co",
+        f"NUM_THREADS={options.get('num_threads', 'ALL_CPUS')}",
+        "-co",
+        f"OVERVIEW_RESAMPLING={options.get('overview_resampling', 'nearest').upper()}",
+        "-co",
+        "OVERVIEWS=AUTO",
+        input_file,
+        output_file,
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to write COG {output_file}: {stderr.decode()}")
+    print(f"Wrote COG: {output_file}")
+
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # Missing, or the rare half-written file on a filesystem without atomic rename
+        return None
+
+
+@contextlib.contextmanager
+def open_raster_for_writing(filename, profile, output_profile=None):
+    """Open an output for writing (e.g. block by block) with the output profile applied"""
+    import rasterio
+
+    out_profile = make_output_profile(profile, output_profile)
+    cog = is_cog_profile(output_profile)
+    # The COG driver can only copy an existing dataset, so write a tiled GeoTIFF next to the
+    # target first and translate it into place.
+    write_path = filename + ".tmp.tif" if cog else filename
+    with rasterio.open(write_path, "w", **out_profile) as dst:
+        yield dst
+    if cog:
+        try:
+            translate_to_cog(write_path, filename, output_profile, out_profile["dtype"])
+        finally:
+            os.remove(write_path)
+
+
+def write_raster_to_file(image, filename, profile, output_profile=None, tags=None):
     print("Writing raster to file: ", filename)
-    with rasterio.open(filename, "w", **profile) as dst:
+    with open_raster_for_writing(filename, profile, output_profile) as dst:
         dst.write(image)
+        if tags:
+            dst.update_tags(**tags)
 
 
-def change_interleave_with_gdal(input_file):
+def change_interleave_with_gdal(input_file, output_profile=None):
+    # Outputs written with a named output profile are already pixel interleaved (or COGs), and
+    # translating them again would drop the compression.
+    if get_output_options(output_profile):
+        return
     with tempfile.NamedTemporaryFile(suffix=".tif", delete=False) as temp_file:
         temp_file_name = temp_file.name
     cmd = ["gdal_translate", "-co", "INTERLEAVE=PIXEL", input_file, temp_file_name]
@@ -0,0 +1,156 @@
+# A small dependency-aware job graph. Each node is a picklable function call with the names of the
+# nodes it depends on. Nodes whose dependencies have finished run concurrently in a process (or
+# thread) pool; a failed node marks everything downstream of it as skipped instead of stopping the run.
+# If a worker process dies (e.g. killed for running out of memory), the pool is recreated and the jobs
+# that were running with it are retried one at a time, so only the job that kills its worker fails.
+
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from loguru import logger
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def has_failures(status):
+    """Whether a status returned by JobGraph.run has failed jobs (None, from a dry run, has none)"""
+    return status is not None and FAILED in status.values()
+
+
+class Job:
+    def __init__(self, name, func, args=(), kwargs=None, deps=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+
+
+class JobGraph:
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        if name in self.jobs:
+            raise ValueError(f"Duplicate job name: {name}")
+        self.jobs[name] = Job(name, func, args, kwargs, deps)
+        return name
+
+    def topological_order(self):
+        """Return the job names ordered so that every job comes after its dependencies"""
+        for job in self.jobs.values():
+            for dep in job.deps:
+                if dep not in self.jobs:
+                    raise ValueError(f"Job {job.name} depends on unknown job {dep}")
+
+        order = []
+        state = {}
+        for name in self.jobs:
+            if name in state:
+                continue
+            # Iterative depth-first search to avoid hitting the recursion limit on big provinces
+            stack = [(name, iter(self.jobs[name].deps))]
+            state[name] = "visiting"
+            while stack:
+                current, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    stack.pop()
+                    state[current] = "visited"
+                    order.append(current)
+                elif state.get(dep) == "visiting":
+                    raise ValueError(f"Dependency cycle between {current} and {dep}")
+                elif dep not in state:
+                    state[dep] = "visiting"
+                    stack.append((dep, iter(self.jobs[dep].deps)))
+        return order
+
+    def run(self, max_workers=None, executor="process"):
+        order = self.topological_order()
+        status = {name: PENDING for name in order}
+        pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        # Submit no more jobs than there are workers, so a broken pool only takes down running jobs
+        max_workers = max_workers or os.cpu_count() or 1
+        running = {}
+        # Jobs that were running when a worker process died. Any of them may have killed it (e.g. the
+        # OOM killer), so each is retried on its own: if it breaks the pool alone it is the culprit.
+        suspects = set()
+
+        pool = pool_cls(max_workers=max_workers)
+        try:
+            while True:
+                # Topological order lets a failure propagate to all its descendants in one pass
+                for name in order:
+                    if status[name] != PENDING:
+                        continue
+                    job = self.jobs[name]
+                    dep_status = [status[dep] for dep in job.deps]
+                    if any(s in (FAILED, SKIPPED) for s in dep_status):
+                        status[name] = SKIPPED
+                        logger.warning(f"Skipping {name}: a dependency did not finish")
+                        continue
+                    if not all(s == DONE for s in dep_status):
+                        continue
+                    if len(running) >= max_workers or suspects & set(running.values()):
+                        continue
+                    if name in suspects and running:
+                        continue
+                    logger.info(f"Starting job {name}")
+                    future = pool.submit(job.func, *job.args, **job.kwargs)
+                    running[future] = name
+                    status[name] = RUNNING
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = []
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        status[name] = DONE
+                        suspects.discard(name)
+                        logger.info(f"Finished job {name}")
+                    except BrokenProcessPool:
+                        broken.append(name)
+                    except Exception as e:
+                        status[name] = FAILED
+                        suspects.discard(name)
+                        logger.error(f"Job {name} failed: {e}")
+
+                if broken:
+                    # Every other running job dies with the pool as well
+                    for future, name in running.items():
+                        future.cancel()
+                        broken.append(name)
+                    running = {}
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = pool_cls(max_workers=max_workers)
+                    if len(broken) == 1:
+                        status[broken[0]] = FAILED
+                        suspects.discard(broken[0])
+                        logger.error(f"Job {broken[0]} failed: its worker process died")
+                    else:
+                        logger.warning(
+                            f"A worker process died while running {broken}, retrying them one at a time"
+                        )
+                        for name in broken:
+                            status[name] = PENDING
+                            suspects.add(name)
+        finally:
+            pool.shutdown()
+
+        counts = {}
+        for s in status.values():
+            counts[s] = counts.get(s, 0) + 1
+        logger.info(f"Job graph finished: {counts}")
+        return status
@@ -0,0 +1,76 @@
+# Overlap reading, computing and writing of tiles with one thread per stage connected by bounded
+# queues. GDAL and most numpy operations release the GIL, so while tile n is being normalized,
+# tile n + 1 is read and tile n - 1 is written. The queue depth caps how many tiles are held in
+# memory between two stages.
+
+import queue
+import threading
+
+_END = object()
+
+
+class _Stage(threading.Thread):
+    def __init__(self, func, inbox, outbox, stop, errors):
+        super().__init__(daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop = stop
+        self.errors = errors
+
+    def put(self, item):
+        # Poll so that a stage blocked on a full queue notices when a downstream stage failed
+        while not self.stop.is_set():
+            try:
+                self.outbox.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def items(self):
+        while not self.stop.is_set():
+            try:
+                item = self.inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def run(self):
+        try:
+            for item in self.items():
+                result = self.func(item)
+                if self.outbox is not None:
+                    self.put(result)
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            if self.outbox is not None:
+                self.put(_END)
+
+
+def run_pipeline(items, read_fn, compute_fn, write_fn, depth=2):
+    """Run write_fn(compute_fn(read_fn(item))) for every item with the three stages overlapped.
+    Raises the first exception raised by any stage."""
+    stop = threading.Event()
+    errors = []
+    source = queue.Queue()
+    for item in items:
+        source.put(item)
+    source.put(_END)
+    read_queue = queue.Queue(maxsize=depth)
+    compute_queue = queue.Queue(maxsize=depth)
+
+    stages = [
+        _Stage(read_fn, source, read_queue, stop, errors),
+        _Stage(compute_fn, read_queue, compute_queue, stop, errors),
+        _Stage(write_fn, compute_queue, None, stop, errors),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    if errors:
+        raise errors[0]
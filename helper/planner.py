@@ -0,0 +1,241 @@
+# Memory planner for the clip, merge and species stages. From the source dtype, band count and the
+# tile windows of the AOI it estimates the bytes read and written and the peak memory of each stage,
+# then picks the number of concurrent workers and, when a whole tile does not fit, the number of rows
+# per block so that workers * peak memory stays within the budget.
+#
+# The per pixel costs below follow what the stages allocate:
+#   clip     raw window + normalized copy + nodata mask + two float64 temporaries of one band
+#   age      raw window + float64 ages + float64 normalized ages + template and mask (never blocked)
+#   merge    every normalized layer + the stacked copy
+#   species  37 normalized layers + their stacked copy + int64 normalize temporary
+#            + 6 float32 output bands + uint32 sum of the other species
+
+import os
+import re
+import numpy as np
+from helper.constants import STRUCTURE_SHORTNAMES
+
+# Blocks smaller than this make the row-by-row passes inefficient, so rather run fewer workers
+MIN_BLOCK_ROWS = 256
+FLOAT64_TEMPORARIES = 16
+SPECIES_OUTPUT_BANDS = 6
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_memory_size(text):
+    """Parse sizes such as 8G, 512M, 1.5GB or a plain number of bytes"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)I?B?\s*", str(text).upper())
+    if match is None:
+        raise ValueError(f"Cannot parse memory size: {text}")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def format_size(num_bytes):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def tile_shapes(tile_index, tile_ids, src, bbox=None):
+    """(height, width) of every tile window on the grid of src"""
+    if bbox is not None:
+        return [(bbox[3] - bbox[1], bbox[2] - bbox[0]) for _ in tile_ids]
+    shapes = []
+    for tile_id in tile_ids:
+        win = tile_index.window(tile_id, src)
+        shapes.append((round(win.height), round(win.width)))
+    return shapes
+
+
+def choose_workers_and_blocks(
+    name, shapes, pixel_cost, memory_budget, max_workers, blockable=True, read_factor=1
+):
+    """Return the plan of one stage. pixel_cost is the peak bytes per pixel of a tile (or block)."""
+    n_jobs = len(shapes)
+    max_height = max(height for height, _ in shapes)
+    max_width = max(width for _, width in shapes)
+    tile_peak = max(height * width for height, width in shapes) * pixel_cost
+    row_cost = max_width * pixel_cost
+    workers = max(1, min(max_workers, n_jobs))
+    block_rows = None
+
+    if memory_budget is not None:
+        while True:
+            per_worker = memory_budget // workers
+            if tile_peak <= per_worker:
+                break
+            if not blockable:
+                if workers == 1:
+                    break
+                workers -= 1
+                continue
+            block_rows = per_worker // row_cost
+            if block_rows >= MIN_BLOCK_ROWS or workers == 1:
+                break
+            workers -= 1
+        if block_rows is not None:
+            if block_rows < 1:
+                raise ValueError(
+                    f"Memory budget of {format_size(memory_budget)} cannot hold one row of {name}"
+                )
+            if block_rows >= MIN_BLOCK_ROWS:
+                block_rows -= block_rows % MIN_BLOCK_ROWS
+            block_rows = min(block_rows, max_height)
+
+    peak = tile_peak if block_rows is None else block_rows * row_cost
+    return {
+        "stage": name,
+        "tiles": n_jobs,
+        "block_rows": block_rows,
+        "workers": workers,
+        "peak_per_worker": peak,
+        "peak": peak * workers,
+        # Block-wise stages read their input twice: once for the ranges, once to write
+        "read_factor": read_factor if block_rows is not None else 1,
+        "fits": memory_budget is None or peak * workers <= memory_budget,
+    }
+
+
+def plan_pipeline(plan, pipeline_depth, raw, shapes, memory_budget=None):
+    """Add the tiles held by the pipeline to a whole-tile clip plan. Workers are reduced until the
+    pipelined peak fits; if it does not fit with one worker, the pipeline is turned off for the stage."""
+    # Tiles queued between the reader, compute and writer threads, each raw + normalized
+    in_flight = 2 * pipeline_depth + 3
+    peak_per_worker = plan["peak_per_worker"] + (in_flight - 1) * 2 * raw * max(
+        h * w for h, w in shapes
+    )
+    workers = plan["workers"]
+    if memory_budget is not None:
+        while workers > 1 and peak_per_worker * workers > memory_budget:
+            workers -= 1
+        if peak_per_worker * workers > memory_budget:
+            plan["pipeline_depth"] = 0
+            return plan
+    plan["pipeline_depth"] = pipeline_depth
+    plan["workers"] = workers
+    plan["peak_per_worker"] = peak_per_worker
+    plan["peak"] = peak_per_worker * workers
+    return plan
+
+
+def plan_memory(config, memory_budget=None, max_workers=None, persist=True):
+    """Plan the stages of a study area config. Returns a list of stage plans.
+    With persist=False (dry runs) the tile index cache is not written."""
+    from clip_ntems import find_ntem_path
+    from helper.envi_reader import open_raster
+    from helper.tile_index import load_tile_index
+
+    max_workers = max_workers or os.cpu_count() or 1
+    tile_index = load_tile_index(config["aoi_path"], persist=persist)
+    tile_ids = tile_index.tile_ids(config["study_area"], config.get("tiles"))
+    bbox = config.get("bbox")
+    pipeline_depth = config.get("pipeline_depth", 0)
+    plans = []
+    if not tile_ids:
+        return plans
+
+    struct_shapes = None
+    for rasin_name in config["ntems"]:
+        rasin_path = find_ntem_path(config["rasin_dir"], rasin_name)
+        with open_raster(rasin_path) as src:
+            shapes = tile_shapes(tile_index, tile_ids, src, bbox)
+            itemsize = np.dtype(src.profile["dtype"]).itemsize
+            bands = src.count
+        raw = bands * itemsize
+        if rasin_name == "age":
+            pixel_cost = raw + 2 * 8 + 2
+            plan = choose_workers_and_blocks(
+                f"clip:{rasin_name}", shapes, pixel_cost, memory_budget, max_workers, False
+            )
+        else:
+            pixel_cost = 2 * raw + bands + FLOAT64_TEMPORARIES
+            plan = choose_workers_and_blocks(
+                f"clip:{rasin_name}", shapes, pixel_cost, memory_budget, max_workers, True, 2
+            )
+        # Age tiles are never blocked, so they are pipelined like whole tiles
+        if plan["block_rows"] is None and pipeline_depth:
+            plan_pipeline(plan, pipeline_depth, raw, shapes, memory_budget)
+        pixels = sum(h * w for h, w in shapes)
+        plan["ntem"] = rasin_name
+        plan["bytes_read"] = pixels * raw * plan["read_factor"]
+        plan["bytes_written"] = pixels * (raw + bands)
+        plans.append(plan)
+        if rasin_name in STRUCTURE_SHORTNAMES and struct_shapes is None:
+            struct_shapes = shapes
+
+    struct_names = [name for name in config["ntems"] if name in STRUCTURE_SHORTNAMES]
+    # A fused merge writes the stack during the clips, so it has no stage of its own
+    if config.get("merge_structures") and not config.get("fused_merge") and struct_names:
+        n_layers = len(struct_names)
+        plan = choose_workers_and_blocks(
+            "merge", struct_shapes, 2 * n_layers, memory_budget, max_workers
+        )
+        pixels = sum(h * w for h, w in struct_shapes)
+        plan["bytes_read"] = pixels * n_layers
+        plan["bytes_written"] = pixels * n_layers
+        plans.append(plan)
+
+    if config.get("species_dir"):
+        import rasterio
+        from crop_species_prob import get_filepaths
+
+        filepaths = get_filepaths(config["species_dir"])
+        with rasterio.open(filepaths[0]) as src:
+            shapes = tile_shapes(tile_index, tile_ids, src)
+            itemsize = np.dtype(src.dtypes[0]).itemsize
+        n_species = len(filepaths)
+        pixel_cost = 2 * n_species + 8 + SPECIES_OUTPUT_BANDS * 4 + 4
+        plan = choose_workers_and_blocks(
+            "species", shapes, pixel_cost, memory_budget, max_workers, True, 2
+        )
+        pixels = sum(h * w for h, w in shapes)
+        plan["bytes_read"] = pixels * n_species * itemsize * plan["read_factor"]
+        plan["bytes_written"] = pixels * SPECIES_OUTPUT_BANDS * itemsize
+        plans.append(plan)
+
+    return plans
+
+
+def apply_plan(config, plans):
+    """Store the block sizes of the plan in the config and return the number of workers to use"""
+    config["clip_block_rows"] = {}
+    config["clip_pipeline_depth"] = {}
+    for plan in plans:
+        if plan["stage"].startswith("clip:"):
+            config["clip_block_rows"][plan["ntem"]] = plan["block_rows"]
+            if "pipeline_depth" in plan:
+                config["clip_pipeline_depth"][plan["ntem"]] = plan["pipeline_depth"]
+        elif plan["stage"] == "merge":
+            config["merge_block_rows"] = plan["block_rows"]
+        elif plan["stage"] == "species":
+            config["species_block_rows"] = plan["block_rows"]
+    return min((plan["workers"] for plan in plans), default=1)
+
+
+def print_plan(plans, memory_budget=None, label=""):
+    budget = format_size(memory_budget) if memory_budget is not None else "unlimited"
+    print(f"Memory plan {label}(budget: {budget})")
+    print(
+        f"{'stage':<24}{'tiles':>6}{'workers':>9}{'block rows':>12}"
+        f"{'read':>14}{'written':>14}{'peak':>14}"
+    )
+    for plan in plans:
+        block_rows = plan["block_rows"] if plan["block_rows"] is not None else "tile"
+        warning = "" if plan["fits"] else "  exceeds budget"
+        if plan.get("pipeline_depth") == 0:
+            warning += "  pipeline off"
+        print(
+            f"{plan['stage']:<24}{plan['tiles']:>6}{plan['workers']:>9}{block_rows:>12}"
+            f"{format_size(plan['bytes_read']):>14}{format_size(plan['bytes_written']):>14}"
+            f"{format_size(plan['peak']):>14}{warning}"
+        )
+    total_read = sum(plan["bytes_read"] for plan in plans)
+    total_written = sum(plan["bytes_written"] for plan in plans)
+    peak = max((plan["peak"] for plan in plans), default=0)
+    print(
+        f"Total read {format_size(total_read)}, written {format_size(total_written)}, "
+        f"peak {format_size(peak)}"
+    )
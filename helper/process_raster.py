@@ -24,6 +24,50 @@ def normalize_image(img, nodata):
     return img
 
 
+# Per band (low, high) of the valid pixels, used to normalize a tile block by block. Ranges of
+# several blocks are combined with merge_band_ranges.
+def compute_band_ranges(img, nodata):
+    ranges = []
+    for i in range(img.shape[0]):
+        X = img[i, :, :]
+        if nodata is not None:
+            X = X[X != nodata]
+        if X.size == 0:
+            ranges.append(None)
+        else:
+            ranges.append((np.min(X), np.max(X)))
+    return ranges
+
+
+def merge_band_ranges(ranges, block_ranges):
+    if ranges is None:
+        return list(block_ranges)
+    merged = []
+    for band_range, block_range in zip(ranges, block_ranges):
+        if band_range is None or block_range is None:
+            merged.append(band_range or block_range)
+        else:
+            merged.append(
+                (min(band_range[0], block_range[0]), max(band_range[1], block_range[1]))
+            )
+    return merged
+
+
+# Same scaling as normalize_image, but with the band ranges of the whole tile so that a block of
+# the tile can be normalized on its own. Returns a new array in the dtype of img.
+def normalize_image_with_ranges(img, nodata, ranges):
+    norm_img = np.zeros_like(img)
+    for i in range(img.shape[0]):
+        if ranges[i] is None:
+            continue
+        low, high = ranges[i]
+        X = img[i, :, :]
+        norm_img[i, :, :] = (X - low) / (high - low) * 254 + 1
+        if nodata is not None:
+            norm_img[i, :, :][X == nodata] = 0
+    return norm_img
+
+
 # This is the current version of normalizing age image
 def normalize_age_image(img, template_path):
     upper_age = 150
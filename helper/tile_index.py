@@ -0,0 +1,192 @@
+# Index of the AOI tiles, built once from the AOI shapefile and cached on disk next to it.
+# It holds tile_id -> geometry and bounds, plus the pixel window of every tile for each source grid
+# (transform and size) it has been asked about, so the stages no longer walk the shapefile or
+# recompute windows.from_bounds for every source.
+
+import hashlib
+import os
+import threading
+import rasterio
+from rasterio.windows import Window
+from helper.constants import STUDY_AREA_TILES
+from helper.io_handler import read_json, write_json_atomic
+
+CACHE_DIR_NAME = ".tile_index"
+CACHE_VERSION = 1
+
+# Indexes already loaded in this process, keyed on the AOI path
+_loaded_indexes = {}
+
+
+def aoi_signature(aoi_path):
+    """Identify the AOI by path, size and modification time of the shapefile and its attributes"""
+    base, _ = os.path.splitext(aoi_path)
+    parts = [os.path.realpath(aoi_path)]
+    for path in (aoi_path, base + ".dbf"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}-{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+def grid_key(transform, width, height):
+    return "|".join(f"{v:.9g}" for v in tuple(transform)[:6]) + f"|{width}x{height}"
+
+
+def default_cache_path(aoi_path):
+    digest = hashlib.sha1(os.path.realpath(aoi_path).encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(aoi_path))[0]
+    return os.path.join(
+        os.path.dirname(os.path.abspath(aoi_path)),
+        CACHE_DIR_NAME,
+        f"{name}-{digest}.json",
+    )
+
+
+class TileIndex:
+    # persist=False keeps the index and the windows computed for it in memory only (e.g. for a dry run)
+    def __init__(self, data, cache_path=None, persist=True):
+        self.signature = data["signature"]
+        self.crs = data["crs"]
+        # Tiles keep the order of the features in the shapefile
+        self.tiles = {int(tile["id"]): tile for tile in data["tiles"]}
+        self.windows = data.get("windows", {})
+        self.cache_path = cache_path
+        self.persist = persist
+        self._geometries = {}
+        # Guards self.windows: jobs of a thread executor share the index. Reentrant since window() saves
+        # while holding it.
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_shapefile(cls, aoi_path, cache_path=None, persist=True):
+        import fiona
+        from shapely.geometry import mapping, shape
+
+        tiles = []
+        with fiona.open(aoi_path, "r") as shapefile:
+            crs = shapefile.crs_wkt
+            for feature in shapefile:
+                geometry = shape(feature["geometry"])
+                tiles.append(
+                    {
+                        "id": int(feature["properties"]["Id"]),
+                        "geometry": mapping(geometry),
+                        "bounds": list(geometry.bounds),
+                    }
+                )
+        data = {
+            "version": CACHE_VERSION,
+            "signature": aoi_signature(aoi_path),
+            "crs": crs,
+            "tiles": tiles,
+            "windows": {},
+        }
+        return cls(data, cache_path, persist)
+
+    def to_dict(self):
+        return {
+            "version": CACHE_VERSION,
+            "signature": self.signature,
+            "crs": self.crs,
+            "tiles": list(self.tiles.values()),
+            "windows": self.windows,
+        }
+
+    def save(self):
+        if self.cache_path is None or not self.persist:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with self._lock:
+                write_json_atomic(self.cache_path, self.to_dict())
+        except OSError as e:
+            # A read-only AOI directory only costs rebuilding the index next run
+            print(f"Could not cache tile index at {self.cache_path}: {e}")
+
+    def __contains__(self, tile_id):
+        return tile_id in self.tiles
+
+    def tile_ids(self, study_area=None, tile_ids=None):
+        """Tile ids in shapefile order, optionally restricted to a study area or a subset"""
+        if tile_ids is None and study_area is not None:
+            tile_ids = STUDY_AREA_TILES[study_area]
+        if tile_ids is None:
+            return list(self.tiles)
+        wanted = set(tile_ids)
+        return [tile_id for tile_id in self.tiles if tile_id in wanted]
+
+    def bounds(self, tile_id):
+        return tuple(self.tiles[tile_id]["bounds"])
+
+    def geojson(self, tile_id):
+        return self.tiles[tile_id]["geometry"]
+
+    def geometry(self, tile_id):
+        if tile_id not in self._geometries:
+            from shapely.geometry import shape
+
+            self._geometries[tile_id] = shape(self.geojson(tile_id))
+        return self._geometries[tile_id]
+
+    def window(self, tile_id, src):
+        """Pixel window of the tile on the grid of src (an open dataset)"""
+        key = grid_key(src.transform, src.width, src.height)
+        with self._lock:
+            if key not in self.windows:
+                # Compute the windows of every tile for this grid at once and persist them
+                self.windows[key] = {
+                    str(tid): list(self._from_bounds(tid, src.transform))
+                    for tid in self.tiles
+                }
+                self.save()
+            col_off, row_off, width, height = self.windows[key][str(tile_id)]
+        return Window(col_off, row_off, width, height)
+
+    def _from_bounds(self, tile_id, transform):
+        win = rasterio.windows.from_bounds(*self.bounds(tile_id), transform=transform)
+        return win.col_off, win.row_off, win.width, win.height
+
+    def intersecting_bbox(self, bbox):
+        """Tiles intersecting a (left, bottom, right, top) box in the AOI CRS"""
+        from shapely.geometry import box
+
+        left, bottom, right, top = bbox
+        query = box(left, bottom, right, top)
+        tile_ids = []
+        for tile_id in self.tiles:
+            t_left, t_bottom, t_right, t_top = self.bounds(tile_id)
+            if t_left > right or t_right < left or t_bottom > top or t_top < bottom:
+                continue
+            if self.geometry(tile_id).intersects(query):
+                tile_ids.append(tile_id)
+        return tile_ids
+
+    def intersecting_raster(self, raster):
+        """Tiles intersecting the extent of a raster path or open dataset"""
+        if isinstance(raster, str):
+            with rasterio.open(raster) as src:
+                return self.intersecting_bbox(tuple(src.bounds))
+        return self.intersecting_bbox(tuple(raster.bounds))
+
+
+def load_tile_index(aoi_path, cache_path=None, persist=True):
+    """Return the tile index of an AOI, from memory, from the on-disk cache, or by reading the shapefile.
+    With persist=False nothing is written to the cache."""
+    cache_path = cache_path or default_cache_path(aoi_path)
+    signature = aoi_signature(aoi_path)
+    index = _loaded_indexes.get(cache_path)
+    if index is not None and index.signature == signature:
+        if persist and not index.persist:
+            index.persist = True
+            index.save()
+        return index
+
+    data = read_json(cache_path)
+    if data and data.get("version") == CACHE_VERSION and data["signature"] == signature:
+        index = TileIndex(data, cache_path, persist)
+    else:
+        index = TileIndex.from_shapefile(aoi_path, cache_path, persist)
+        index.save()
+    _loaded_indexes[cache_path] = index
+    return index
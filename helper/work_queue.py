@@ -0,0 +1,346 @@
+# Work queue on a shared filesystem for spreading jobs over several processes or cluster nodes.
+# No external service is needed, only a directory every worker can see:
+#
+#   queue_dir/
+#       jobs/<job_id>.json      job spec: importable function, arguments and dependencies
+#       locks/<job_id>.lock     lease of the worker running the job; its mtime is the heartbeat
+#       done/<job_id>.json      completion record
+#       attempts/<job_id>.json  number of times the job was claimed
+#       failures/<job_id>.json  last error raised by the job
+#
+# A worker claims a job by creating its lock file with O_CREAT | O_EXCL, which is atomic on local
+# filesystems and NFSv3+. While the job runs, a heartbeat thread touches the lock. A lock whose
+# heartbeat is older than the lease is considered abandoned (crashed worker or dead node) and can
+# be taken over, so jobs are retried automatically. Attempts are counted when a job is claimed, not
+# when it fails, so a job that kills its worker (out of memory, a crash in GDAL) also runs out of
+# attempts instead of taking down one worker after another.
+
+import importlib
+import multiprocessing
+import os
+import re
+import socket
+import threading
+import time
+import traceback
+import uuid
+from loguru import logger
+from helper.io_handler import read_json, write_json_atomic
+
+
+def make_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def to_job_id(name):
+    # Job names are used as file names, so keep them portable
+    return re.sub(r"[^A-Za-z0-9._-]", "_", name)
+
+
+def func_ref(func):
+    return f"{func.__module__}:{func.__qualname__}"
+
+
+def resolve_func(ref):
+    module_name, qualname = ref.split(":")
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class WorkQueue:
+    def __init__(self, queue_dir, lease_seconds=600, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for sub_dir in ("jobs", "locks", "done", "attempts", "failures"):
+            os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+
+    def _path(self, sub_dir, job_id, ext):
+        return os.path.join(self.queue_dir, sub_dir, job_id + ext)
+
+    def enqueue(self, job_id, func, args=(), kwargs=None, deps=()):
+        """Add a job unless a job with the same id is already queued"""
+        job_path = self._path("jobs", job_id, ".json")
+        if os.path.exists(job_path):
+            return False
+        job = {
+            "id": job_id,
+            "func": func if isinstance(func, str) else func_ref(func),
+            "args": list(args),
+            "kwargs": kwargs or {},
+            "deps": list(deps),
+        }
+        write_json_atomic(job_path, job)
+        return True
+
+    def job_ids(self):
+        return sorted(
+            os.path.splitext(name)[0]
+            for name in os.listdir(os.path.join(self.queue_dir, "jobs"))
+            if name.endswith(".json")
+        )
+
+    def is_done(self, job_id):
+        return os.path.exists(self._path("done", job_id, ".json"))
+
+    def attempts(self, job_id):
+        attempt = read_json(self._path("attempts", job_id, ".json"))
+        return attempt["attempts"] if attempt else 0
+
+    def is_leased(self, job_id):
+        return not self._lock_is_expired(self._path("locks", job_id, ".lock"))
+
+    def is_exhausted(self, job_id):
+        # The last attempt may still be running
+        return self.attempts(job_id) >= self.max_attempts and not self.is_leased(job_id)
+
+    def _lock_is_expired(self, lock_path):
+        try:
+            return time.time() - os.path.getmtime(lock_path) > self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def _record_attempt(self, job_id, worker_id):
+        # Only the holder of the lock writes the record, so the count cannot race
+        write_json_atomic(
+            self._path("attempts", job_id, ".json"),
+            {
+                "worker": worker_id,
+                "attempts": self.attempts(job_id) + 1,
+                "started": time.time(),
+            },
+        )
+
+    def _try_lock(self, job_id, worker_id):
+        lock_path = self._path("locks", job_id, ".lock")
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._lock_is_expired(lock_path) or not self._break_lock(lock_path):
+                return False
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_id)
+        return True
+
+    def _break_lock(self, lock_path):
+        # Renaming is atomic, so only one of several workers racing for an expired lock moves it
+        stale_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return True
+        if not self._lock_is_expired(stale_path):
+            # Another worker took the lease between our expiry check and the rename. Put it back
+            # without clobbering; if that fails its owner notices the lost lease on the next heartbeat.
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        logger.warning(f"Lease expired, taking over {os.path.basename(lock_path)}")
+        os.remove(stale_path)
+        return True
+
+    def owns_lock(self, job_id, worker_id):
+        try:
+            with open(self._path("locks", job_id, ".lock"), "r") as f:
+                return f.read() == worker_id
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, job_id, worker_id):
+        """Refresh the lease. Returns False if the lease was lost to another worker."""
+        if not self.owns_lock(job_id, worker_id):
+            return False
+        os.utime(self._path("locks", job_id, ".lock"))
+        return True
+
+    def release(self, job_id, worker_id):
+        if self.owns_lock(job_id, worker_id):
+            os.remove(self._path("locks", job_id, ".lock"))
+
+    def claim(self, worker_id):
+        """Claim the first runnable job: not done, not out of attempts, dependencies done"""
+        for job_id in self.job_ids():
+            if self.is_done(job_id) or self.attempts(job_id) >= self.max_attempts:
+                continue
+            job = read_json(self._path("jobs", job_id, ".json"))
+            if job is None or not all(self.is_done(dep) for dep in job["deps"]):
+                continue
+            if not self._try_lock(job_id, worker_id):
+                continue
+            # The job may have finished or used up its attempts between the checks and taking the lock
+            if self.is_done(job_id) or self.attempts(job_id) >= self.max_attempts:
+                self.release(job_id, worker_id)
+                continue
+            self._record_attempt(job_id, worker_id)
+            return job
+        return None
+
+    def complete(self, job_id, worker_id, elapsed):
+        write_json_atomic(
+            self._path("done", job_id, ".json"),
+            {"worker": worker_id, "elapsed": elapsed, "finished": time.time()},
+        )
+        self.release(job_id, worker_id)
+
+    def fail(self, job_id, worker_id, error):
+        write_json_atomic(
+            self._path("failures", job_id, ".json"),
+            {
+                "worker": worker_id,
+                "attempts": self.attempts(job_id),
+                "error": error,
+            },
+        )
+        self.release(job_id, worker_id)
+
+    def _failed_and_remaining(self):
+        """Jobs out of attempts, jobs waiting (directly or not) on one of those, and the other jobs
+        that are not done"""
+        failed = set()
+        remaining = []
+        for job_id in self.job_ids():
+            if self.is_done(job_id):
+                continue
+            if self.is_exhausted(job_id):
+                failed.add(job_id)
+            else:
+                remaining.append(job_id)
+        blocked = set()
+        deps = {}
+        for job_id in remaining:
+            job = read_json(self._path("jobs", job_id, ".json"))
+            deps[job_id] = job["deps"] if job else []
+        changed = True
+        while changed:
+            changed = False
+            for job_id in remaining:
+                if job_id in blocked:
+                    continue
+                if any(dep in failed or dep in blocked for dep in deps[job_id]):
+                    blocked.add(job_id)
+                    changed = True
+        return failed, blocked, [job_id for job_id in remaining if job_id not in blocked]
+
+    def is_drained(self):
+        """True when no job can run anymore: everything is done, out of attempts, or waiting on a
+        job that is out of attempts"""
+        _, _, runnable = self._failed_and_remaining()
+        return not runnable
+
+    def status(self):
+        failed, blocked, runnable = self._failed_and_remaining()
+        counts = {
+            "done": sum(1 for job_id in self.job_ids() if self.is_done(job_id)),
+            "running": 0,
+            "failed": len(failed),
+            "blocked": len(blocked),
+            "pending": 0,
+        }
+        for job_id in runnable:
+            if os.path.exists(self._path("locks", job_id, ".lock")):
+                counts["running"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
+
+    def has_failures(self):
+        """Whether jobs ran out of attempts, or wait on such a job and can never run"""
+        counts = self.status()
+        return counts["failed"] + counts["blocked"] > 0
+
+
+class Heartbeat:
+    """Touch the lease of a running job in the background"""
+
+    def __init__(self, queue, job_id, worker_id, interval):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.job_id, self.worker_id):
+                self.lost = True
+                logger.warning(f"Lost the lease on {self.job_id}")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    queue_dir,
+    worker_id=None,
+    lease_seconds=600,
+    heartbeat_seconds=None,
+    poll_seconds=10,
+    max_attempts=3,
+):
+    """Claim and run jobs until the queue is drained. Returns the number of jobs this worker finished."""
+    queue = WorkQueue(queue_dir, lease_seconds, max_attempts)
+    worker_id = worker_id or make_worker_id()
+    heartbeat_seconds = heartbeat_seconds or max(lease_seconds / 4, 1)
+    finished = 0
+    logger.info(f"Worker {worker_id} polling {queue_dir}")
+
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            if queue.is_drained():
+                break
+            # Jobs are running elsewhere or waiting on dependencies
+            time.sleep(poll_seconds)
+            continue
+
+        job_id = job["id"]
+        logger.info(f"Worker {worker_id} running {job_id}")
+        start = time.time()
+        with Heartbeat(queue, job_id, worker_id, heartbeat_seconds) as heartbeat:
+            try:
+                resolve_func(job["func"])(*job["args"], **job["kwargs"])
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+        if heartbeat.lost:
+            # Another worker took over and is responsible for the job now
+            continue
+        if error is None:
+            queue.complete(job_id, worker_id, time.time() - start)
+            finished += 1
+        else:
+            logger.error(f"Job {job_id} failed on {worker_id}: {error}")
+            queue.fail(job_id, worker_id, error)
+
+    logger.info(f"Worker {worker_id} finished {finished} jobs, queue: {queue.status()}")
+    return finished
+
+
+def run_workers(queue_dir, num_workers, **worker_kwargs):
+    """Run several workers on this host, each in its own process"""
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(queue_dir,), kwargs=worker_kwargs)
+        for _ in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
@@ -0,0 +1,262 @@
+# Build and run the job graph for one or more study areas from a JSON config file.
+# Every (ntem, tile) clip is its own node, so independent layers and tiles run concurrently, while
+# the dependencies that used to be implied by the order of config["ntems"] are explicit edges:
+#   - age of a tile needs the normalized gross_stem_volume of that tile as its mask template
+#   - merging the structure layers of a tile needs all of the tile's structure clips
+#   - with "fused_merge", the structure clips of a tile write into one merged stack, so they wait for
+#     the stack to be created (band writes are serialized by a lock on the stack, not by the graph)
+# VRI cropping and rasterizing (one node) and species cropping do not depend on the clips and run alongside them.
+#
+# Example config:
+# {
+#     "max_workers": 8,
+#     "executor": "process",
+#     "defaults": {"output_profile": "deflate", "merge_structures": true},
+#     "study_areas": [
+#         {
+#             "study_area": "bc",
+#             "aoi_path": "/path/quesnel_study_area.shp",
+#             "rasin_dir": "/path/bc/mosaiced/",
+#             "out_dir": "/path/bc/processed_tiles/",
+#             "vri_path": "/path/final_bc_vri.shp",
+#             "ntems": ["proxies", "gross_stem_volume", "age"]
+#         },
+#         {
+#             "study_area": "nb",
+#             "aoi_path": "/path/nb_study_area.shp",
+#             "rasin_dir": "/path/nb/mosaiced/",
+#             "out_dir": "/path/nb/processed_tiles/",
+#             "species_dir": "/path/2019_CA_forest_tree_species_probabilities/",
+#             "ntems": ["proxies", "elev_p95", "elev_cv"],
+#             "tiles": [305, 306]
+#         }
+#     ]
+# }
+# An optional "memory_budget" (e.g. "32G") plans block sizes and the number of workers, see helper/planner.py.
+
+import json
+from clip_ntems import (
+    clip_ntems_to_aoi,
+    create_merged_structure_rasters,
+    finalize_merged_structure_rasters,
+    find_ntem_path,
+    get_struct_names,
+    merge_structure_rasters,
+    process_vri,
+)
+from helper.job_graph import JobGraph
+from helper.planner import apply_plan, parse_memory_size, plan_memory, print_plan
+from helper.tile_index import load_tile_index
+from helper.work_queue import WorkQueue, func_ref, to_job_id
+from loguru import logger
+
+# Keys of the per study area config, with the same meaning as the config built in main.py
+AREA_DEFAULTS = {
+    "merge_structures": False,
+    "fused_merge": False,
+    "vri_path": None,
+    "rasterize_vri": False,
+    "vri_fields": [],
+    "vri_grid_ntem": None,
+    "bbox": None,
+    "ntems": [],
+    "output_profile": None,
+    "species_dir": None,
+    "tiles": None,
+    "pipeline_depth": 0,
+    "clip_block_rows": None,
+    "merge_block_rows": None,
+    "species_block_rows": None,
+    "chunk_cache_dir": None,
+    "chunk_cache_size": None,
+}
+
+AGE_TEMPLATE_NTEM = "gross_stem_volume"
+
+
+def load_run_config(config_path):
+    with open(config_path, "r") as f:
+        run_config = json.load(f)
+    defaults = run_config.get("defaults", {})
+    areas = []
+    for area in run_config["study_areas"]:
+        area_config = dict(AREA_DEFAULTS)
+        area_config.update(defaults)
+        area_config.update(area)
+        for key in ("study_area", "aoi_path", "out_dir"):
+            if key not in area_config:
+                raise ValueError(f"Study area config is missing {key}: {area}")
+        if area_config["bbox"] is not None:
+            area_config["bbox"] = tuple(area_config["bbox"])
+            assert len(area_config["bbox"]) == 4
+        if area_config["pipeline_depth"]:
+            # Every clip node covers a single tile, so a pipeline would have nothing to overlap
+            logger.warning("pipeline_depth is ignored in job graphs, tiles run as separate jobs")
+            area_config["pipeline_depth"] = 0
+        areas.append(area_config)
+    run_config["study_areas"] = areas
+    return run_config
+
+
+def add_study_area_jobs(graph, config, label, persist=True):
+    tile_ids = load_tile_index(config["aoi_path"], persist=persist).tile_ids(
+        config["study_area"], config["tiles"]
+    )
+    ntems = config["ntems"]
+    clip_jobs = {}
+    struct_names = get_struct_names(config)
+    fused = bool(config["merge_structures"] and config["fused_merge"] and struct_names)
+    if fused:
+        for tile_id in tile_ids:
+            graph.add(
+                f"{label}:merge_init:{tile_id}",
+                create_merged_structure_rasters,
+                config,
+                tile_ids=[tile_id],
+            )
+
+    for rasin_name in ntems:
+        rasin_path = find_ntem_path(config["rasin_dir"], rasin_name)
+        assert rasin_path is not None, f"No .dat found for {rasin_name}"
+        for tile_id in tile_ids:
+            deps = []
+            if rasin_name == "age":
+                if AGE_TEMPLATE_NTEM in ntems:
+                    deps.append(f"{label}:clip:{AGE_TEMPLATE_NTEM}:{tile_id}")
+                else:
+                    logger.warning(
+                        f"age of tile {tile_id} uses an existing {AGE_TEMPLATE_NTEM} output as its template"
+                    )
+            if fused and rasin_name in struct_names:
+                deps.append(f"{label}:merge_init:{tile_id}")
+            clip_jobs[(rasin_name, tile_id)] = graph.add(
+                f"{label}:clip:{rasin_name}:{tile_id}",
+                clip_ntems_to_aoi,
+                rasin_name,
+                rasin_path,
+                config["aoi_path"],
+                config["out_dir"],
+                config["study_area"],
+                config["bbox"],
+                config["output_profile"],
+                tile_ids=[tile_id],
+                block_rows=(config["clip_block_rows"] or {}).get(rasin_name),
+                chunk_cache_dir=config["chunk_cache_dir"],
+                chunk_cache_size=config["chunk_cache_size"],
+                fused_struct_names=struct_names if fused else None,
+                deps=deps,
+            )
+
+    if config["merge_structures"] and struct_names:
+        merge_func = (
+            finalize_merged_structure_rasters if fused else merge_structure_rasters
+        )
+        for tile_id in tile_ids:
+            graph.add(
+                f"{label}:merge:{tile_id}",
+                merge_func,
+                config,
+                tile_ids=[tile_id],
+                deps=[clip_jobs[(name, tile_id)] for name in struct_names],
+            )
+
+    # The VRI is read once per study area, so crop and rasterize all tiles in a single node
+    if config["vri_path"]:
+        graph.add(f"{label}:vri", process_vri, config, tile_ids=tile_ids)
+
+    if config["species_dir"]:
+        # Imported here because the species script is otherwise standalone
+        from crop_species_prob import crop_species_for_tiles
+
+        for tile_id in tile_ids:
+            graph.add(
+                f"{label}:species:{tile_id}",
+                crop_species_for_tiles,
+                config["aoi_path"],
+                config["species_dir"],
+                config["out_dir"],
+                tile_ids=[tile_id],
+                output_profile=config["output_profile"],
+                block_rows=config["species_block_rows"],
+                chunk_cache_dir=config["chunk_cache_dir"],
+                chunk_cache_size=config["chunk_cache_size"],
+            )
+
+
+# Building the graph has no side effects with persist=False: the stages create their output directories
+# themselves and the tile index cache is only written when persisting.
+def build_job_graph(run_config, persist=True):
+    graph = JobGraph()
+    labels = set()
+    for config in run_config["study_areas"]:
+        # Several entries can share a study area code (e.g. different AOIs), so default to a unique label
+        label = config.get("name", config["study_area"])
+        if label in labels:
+            label = f"{label}-{len(labels)}"
+        labels.add(label)
+        add_study_area_jobs(graph, config, label, persist)
+    return graph
+
+
+def plan_run_config(run_config, memory_budget=None, max_workers=None, persist=True):
+    """Plan every study area against the memory budget, store the block sizes in the area configs
+    and return the number of workers that keeps all stages within the budget"""
+    workers = max_workers
+    for config in run_config["study_areas"]:
+        plans = plan_memory(config, memory_budget, max_workers, persist)
+        print_plan(plans, memory_budget, label=f"for {config['study_area']} ")
+        area_workers = apply_plan(config, plans)
+        workers = area_workers if workers is None else min(workers, area_workers)
+    return workers
+
+
+def get_memory_budget(run_config, memory_budget=None):
+    memory_budget = memory_budget or run_config.get("memory_budget")
+    return parse_memory_size(memory_budget) if memory_budget is not None else None
+
+
+def run_jobs_from_config(
+    config_path, max_workers=None, executor=None, memory_budget=None, dry_run=False
+):
+    run_config = load_run_config(config_path)
+    max_workers = max_workers or run_config.get("max_workers")
+    memory_budget = get_memory_budget(run_config, memory_budget)
+    if memory_budget is not None or dry_run:
+        max_workers = plan_run_config(
+            run_config, memory_budget, max_workers, persist=not dry_run
+        )
+    graph = build_job_graph(run_config, persist=not dry_run)
+    if dry_run:
+        print(f"Dry run: {len(graph.jobs)} jobs with {max_workers} workers")
+        return None
+    logger.info(f"Running {len(graph.jobs)} jobs from {config_path}")
+    return graph.run(
+        max_workers=max_workers,
+        executor=executor or run_config.get("executor", "process"),
+    )
+
+
+def enqueue_jobs_from_config(config_path, queue_dir, memory_budget=None, max_workers=None):
+    """Put the job graph of a config into a shared-filesystem queue for run_worker to pick up.
+    With a memory budget (per node), the queued jobs get the block sizes of the plan for
+    max_workers workers per node."""
+    run_config = load_run_config(config_path)
+    memory_budget = get_memory_budget(run_config, memory_budget)
+    if memory_budget is not None:
+        max_workers = max_workers or run_config.get("max_workers")
+        workers = plan_run_config(run_config, memory_budget, max_workers)
+        logger.info(f"Start at most {workers} workers per node to stay within the memory budget")
+    graph = build_job_graph(run_config)
+    queue = WorkQueue(queue_dir)
+    added = 0
+    for name in graph.topological_order():
+        job = graph.jobs[name]
+        added += queue.enqueue(
+            to_job_id(name),
+            func_ref(job.func),
+            job.args,
+            job.kwargs,
+            [to_job_id(dep) for dep in job.deps],
+        )
+    logger.info(f"Queued {added} new jobs in {queue_dir}, queue: {queue.status()}")
+    return added
@@ -9,25 +9,20 @@
 # The above command will clip the ntems to a 500x500 window starting from the top left corner of the tile, and
 # also merge lidar-derived structure ntems into one file.
 
-import ast
-from clip_ntems import clip_multiple_ntems_to_aoi
-import argparse
-from loguru import logger
-
+# To process several study areas and ntems in one invocation, describe them in a JSON config file
+# (see the top comments in jobs.py) and run: python3 main.py --config=run.json --max_workers=8
+# Independent clips, merges, VRI and species crops then run concurrently as a job graph.
 
-logger.add(
-    "logs/main.log",
-    format="{time} {level} {message}",
-    level="INFO",
-    rotation="1 week",
-)
+# To spread the same jobs over several nodes, queue them in a directory on a shared filesystem and
+# start workers on every node; workers claim jobs with lock files and take over jobs of crashed workers:
+#   python3 main.py --config=run.json --queue_dir=/shared/queue --enqueue
+#   python3 main.py --queue_dir=/shared/queue --worker --max_workers=4   # on each node
 
+# The individual stages are also available as subcommands: python3 -m ntems_clipping --help
 
-def tuple_type(s):
-    try:
-        return tuple(ast.literal_eval(s))
-    except:
-        raise argparse.ArgumentTypeError("Tuple arguments must be a tuple")
+import argparse
+from helper.constants import OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE
+from ntems_clipping.cli import setup_logging, tuple_type
 
 
 def main():
@@ -38,12 +33,37 @@ def main():
         default=False,
         help="Merge the clipped structure ntems into one file",
     )
+    parser.add_argument(
+        "--fused_merge",
+        action="store_true",
+        default=False,
+        help="With --merge_structures, write each structure layer into the merged file during the clip instead of merging afterwards",
+    )
     parser.add_argument(
         "--vri_path",
         type=str,
         default="/mnt/f/first_project_backup/ntems_2019/provincial_vegetation_inventory/final_bc_vri.shp",
         help="path to the VRI shapefile",
     )
+    parser.add_argument(
+        "--rasterize_vri",
+        action="store_true",
+        default=False,
+        help="Also burn the VRI into rasters on the pixel grid of each tile",
+    )
+    parser.add_argument(
+        "--vri_fields",
+        type=str,
+        nargs="+",
+        default=[],
+        help="VRI attributes to rasterize besides the polygon id",
+    )
+    parser.add_argument(
+        "--vri_grid_ntem",
+        type=str,
+        default=None,
+        help="ntem whose tile grid the VRI rasters align to (default: the first of --ntems)",
+    )
     parser.add_argument(
         "--out_dir",
         type=str,
@@ -74,7 +94,131 @@ def main():
         help="choose from bc, ab, on, and nb",
         default="bc",
     )
+    parser.add_argument(
+        "--output_profile",
+        type=str,
+        choices=list(OUTPUT_PROFILES),
+        default=DEFAULT_OUTPUT_PROFILE,
+        help="Creation options for the output GeoTIFFs (tiling, compression, COG)",
+    )
+    parser.add_argument(
+        "--ntems",
+        type=str,
+        nargs="+",
+        default=[],
+        help="ntems to clip, e.g. proxies gross_stem_volume age",
+    )
+    parser.add_argument(
+        "--pipeline_depth",
+        type=int,
+        default=0,
+        help="Overlap reading, normalizing and writing of tiles, holding at most this many tiles between stages (0 runs serially)",
+    )
+    parser.add_argument(
+        "--chunk_cache_dir",
+        type=str,
+        default=None,
+        help="Local directory caching blocks of the source rasters across runs (off by default)",
+    )
+    parser.add_argument(
+        "--chunk_cache_size",
+        type=str,
+        default="20G",
+        help="Size cap of the chunk cache, least recently used blocks are evicted beyond it",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        "--memory-budget",
+        type=str,
+        default=None,
+        help="Memory to stay within, e.g. 32G; picks block sizes and worker counts per stage",
+    )
+    parser.add_argument(
+        "--dry_run",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Print the memory plan (bytes read and written, peak memory) and exit",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="JSON config describing several study areas; runs them as a job graph",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="Number of concurrent jobs when running from --config",
+    )
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=["process", "thread"],
+        default=None,
+        help="Pool used to run the job graph when running from --config",
+    )
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        default=None,
+        help="Shared directory of the work queue used with --enqueue and --worker",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        default=False,
+        help="Queue the jobs of --config in --queue_dir instead of running them",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        default=False,
+        help="Run --max_workers worker processes on the jobs in --queue_dir",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=600,
+        help="Seconds without a heartbeat after which a claimed job is taken over",
+    )
     args = parser.parse_args()
+    setup_logging()
+    # Stages are imported for the branch that runs them, so e.g. workers do not load geopandas
+    if args.worker:
+        from helper.work_queue import WorkQueue, run_workers
+
+        assert args.queue_dir is not None, "--worker requires --queue_dir"
+        run_workers(
+            args.queue_dir, args.max_workers or 1, lease_seconds=args.lease_seconds
+        )
+        # The workers only stop once the queue is drained, so failures are final here
+        if WorkQueue(args.queue_dir, args.lease_seconds).has_failures():
+            raise SystemExit(1)
+        return
+    if args.enqueue:
+        from jobs import enqueue_jobs_from_config
+
+        assert args.config is not None and args.queue_dir is not None
+        enqueue_jobs_from_config(
+            args.config, args.queue_dir, args.memory_budget, args.max_workers
+        )
+        return
+    if args.config is not None:
+        from helper.job_graph import has_failures
+        from jobs import run_jobs_from_config
+
+        status = run_jobs_from_config(
+            args.config,
+            args.max_workers,
+            args.executor,
+            args.memory_budget,
+            args.dry_run,
+        )
+        if has_failures(status):
+            raise SystemExit(1)
+        return
     # Get the arguments if not empty
     merge_structures = args.merge_structures
     out_dir = args.out_dir
@@ -83,19 +227,45 @@ def main():
     vri_path = args.vri_path
     bbox = args.bbox
     study_area = args.study_area
+    output_profile = args.output_profile
     assert bbox is None or len(bbox) == 4
     print("bbox: ", bbox)
 
     config = {
         "merge_structures": merge_structures,
+        "fused_merge": args.fused_merge,
         "vri_path": vri_path,
+        "rasterize_vri": args.rasterize_vri,
+        "vri_fields": args.vri_fields,
+        "vri_grid_ntem": args.vri_grid_ntem,
         "out_dir": out_dir,
         "rasin_dir": rasin_dir,
         "aoi_path": aoi_path,
         "bbox": bbox,
-        "ntems": [],
+        "ntems": args.ntems,
         "study_area": study_area,
+        "output_profile": output_profile,
+        "pipeline_depth": args.pipeline_depth,
+        "chunk_cache_dir": args.chunk_cache_dir,
+        "chunk_cache_size": args.chunk_cache_size,
     }
+    if args.memory_budget is not None or args.dry_run:
+        from helper.planner import apply_plan, parse_memory_size, plan_memory, print_plan
+
+        memory_budget = (
+            parse_memory_size(args.memory_budget) if args.memory_budget else None
+        )
+        # Stages run one tile at a time here, so plan for a single worker
+        plans = plan_memory(
+            config, memory_budget, max_workers=1, persist=not args.dry_run
+        )
+        print_plan(plans, memory_budget)
+        if args.dry_run:
+            return
+        apply_plan(config, plans)
+
+    from clip_ntems import clip_multiple_ntems_to_aoi
+
     clip_multiple_ntems_to_aoi(config)
 
 
@@ -5,6 +5,7 @@ import rasterio
 from rasterio.merge import merge
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import glob
+from helper.io_handler import write_raster_to_file
 
 
 def find_raster_groups(input_base):
@@ -49,7 +50,7 @@ def reproject_raster(src_path, dst_path, dst_crs):
                 )
 
 
-def mosaic_rasters(file_groups, output_base, dst_crs="EPSG:3978"):
+def mosaic_rasters(file_groups, output_base, dst_crs="EPSG:3978", output_profile=None):
     """
     Reprojects and mosaics raster files from the given file groups.
     """
@@ -90,14 +91,16 @@ def mosaic_rasters(file_groups, output_base, dst_crs="EPSG:3978"):
         )
         print("Mosaiced meta is ", out_meta)
 
-        with rasterio.open(out_file, "w", **out_meta) as dst:
-            dst.write(mosaic)
+        write_raster_to_file(mosaic, out_file, out_meta, output_profile)
 
 
 if __name__ == "__main__":
     # Base directories for input and output
     input_base = "/mnt/e/cfs/first_project/ntems_2019/nb"
     output_base = "/mnt/e/cfs/first_project/ntems_2019/nb/mosaiced"
+    # One of the keys in helper.constants.OUTPUT_PROFILES. Compressed profiles make the mosaics
+    # much smaller to copy to the cluster and faster to read by window.
+    output_profile = "envi"
 
     raster_groups = find_raster_groups(input_base)
-    mosaic_rasters(raster_groups, output_base)
+    mosaic_rasters(raster_groups, output_base, output_profile=output_profile)
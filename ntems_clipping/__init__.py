@@ -0,0 +1,55 @@
+# Library API of the ntems clipping scripts. Everything is resolved on first access, so importing
+# the package does not load rasterio, geopandas, fiona or shapely and never starts a job.
+#
+#   import ntems_clipping
+#   ntems_clipping.clip_ntems_to_aoi("proxies", rasin_path, aoi_path, out_dir, "bc")
+
+import importlib
+
+_API = {
+    "clip_ntems_to_aoi": "clip_ntems",
+    "clip_multiple_ntems_to_aoi": "clip_ntems",
+    "merge_structure_rasters": "clip_ntems",
+    "create_merged_structure_rasters": "clip_ntems",
+    "finalize_merged_structure_rasters": "clip_ntems",
+    "stack_rasters_and_write_to_file": "clip_ntems",
+    "crop_vri_shapefile": "clip_ntems",
+    "rasterize_vri_for_tiles": "clip_ntems",
+    "process_vri": "clip_ntems",
+    "filter_forested_polygon_from_vri": "clip_ntems",
+    "find_ntem_path": "clip_ntems",
+    "crop_species_for_tiles": "crop_species_prob",
+    "find_raster_groups": "mosaic_rasters",
+    "mosaic_rasters": "mosaic_rasters",
+    "crop_layers": "crop_layers",
+    "crop_layer_into_smaller_blocks": "crop_layers",
+    "build_job_graph": "jobs",
+    "run_jobs_from_config": "jobs",
+    "enqueue_jobs_from_config": "jobs",
+    "JobGraph": "helper.job_graph",
+    "WorkQueue": "helper.work_queue",
+    "run_worker": "helper.work_queue",
+    "run_workers": "helper.work_queue",
+    "load_tile_index": "helper.tile_index",
+    "open_raster": "helper.envi_reader",
+    "normalize_image": "helper.process_raster",
+    "normalize_age_image": "helper.process_raster",
+    "STRUCTURE_SHORTNAMES": "helper.constants",
+    "STUDY_AREA_TILES": "helper.constants",
+    "OUTPUT_PROFILES": "helper.constants",
+}
+
+__all__ = sorted(_API)
+
+
+def __getattr__(name):
+    if name not in _API:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_API[name]), name)
+    # Cache on the package so the lookup only happens once
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,4 @@
+from ntems_clipping.cli import main
+
+if __name__ == "__main__":
+    main()
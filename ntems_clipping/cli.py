@@ -0,0 +1,420 @@
+# Subcommand CLI for the individual stages:
+#   python3 -m ntems_clipping clip --rasin_dir=... --aoi_path=... --out_dir=... --ntems proxies elev_p95
+#   python3 -m ntems_clipping merge --aoi_path=... --out_dir=... --ntems elev_p95 elev_cv
+#   python3 -m ntems_clipping vri --vri_path=... --aoi_path=... --out_dir=...
+#   python3 -m ntems_clipping rasterize --vri_path=... --rasin_dir=... --aoi_path=... --out_dir=... --fields=...
+#   python3 -m ntems_clipping species --species_dir=... --aoi_path=... --out_dir=...
+#   python3 -m ntems_clipping mosaic --input_base=... --output_base=...
+#   python3 -m ntems_clipping chips --input_dir=... --width=1000 --height=1000
+#   python3 -m ntems_clipping run --config=run.json
+#   python3 -m ntems_clipping enqueue --config=run.json --queue_dir=...
+#   python3 -m ntems_clipping worker --queue_dir=...
+# Every stage module is imported inside its handler, so a subcommand only loads what it uses.
+
+import argparse
+import ast
+from helper.constants import DEFAULT_OUTPUT_PROFILE, OUTPUT_PROFILES
+
+
+def setup_logging():
+    from loguru import logger
+
+    logger.add(
+        "logs/main.log",
+        format="{time} {level} {message}",
+        level="INFO",
+        rotation="1 week",
+    )
+
+
+def tuple_type(s):
+    try:
+        return tuple(ast.literal_eval(s))
+    except:
+        raise argparse.ArgumentTypeError("Tuple arguments must be a tuple")
+
+
+def add_tile_arguments(parser, bbox=True):
+    parser.add_argument(
+        "--aoi_path",
+        type=str,
+        required=True,
+        help="Path to the shapefile containing the AOI",
+    )
+    parser.add_argument(
+        "--out_dir", type=str, required=True, help="Output directory of the tiles"
+    )
+    parser.add_argument(
+        "--study_area",
+        type=str,
+        help="choose from bc, ab, on, and nb",
+        default="bc",
+    )
+    parser.add_argument(
+        "--tiles",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Only process these tile ids instead of all tiles of the study area",
+    )
+    if bbox:
+        parser.add_argument(
+            "--bbox",
+            type=tuple_type,
+            default=None,
+            help="Bounding box (column_offset, row_offset, width, height)",
+        )
+
+
+def add_output_profile_argument(parser):
+    parser.add_argument(
+        "--output_profile",
+        type=str,
+        choices=list(OUTPUT_PROFILES),
+        default=DEFAULT_OUTPUT_PROFILE,
+        help="Creation options for the output GeoTIFFs (tiling, compression, COG)",
+    )
+
+
+def add_ntems_argument(parser):
+    parser.add_argument(
+        "--ntems",
+        type=str,
+        nargs="+",
+        required=True,
+        help="ntems to process, e.g. proxies gross_stem_volume age",
+    )
+
+
+def add_block_rows_argument(parser):
+    parser.add_argument(
+        "--block_rows",
+        type=int,
+        default=None,
+        help="Process each tile in blocks of this many rows to bound memory",
+    )
+
+
+def add_chunk_cache_arguments(parser):
+    parser.add_argument(
+        "--chunk_cache_dir",
+        type=str,
+        default=None,
+        help="Local directory caching blocks of the source rasters across runs (off by default)",
+    )
+    parser.add_argument(
+        "--chunk_cache_size",
+        type=str,
+        default="20G",
+        help="Size cap of the chunk cache, least recently used blocks are evicted beyond it",
+    )
+
+
+def make_config(args, **extra):
+    config = {
+        "aoi_path": args.aoi_path,
+        "out_dir": args.out_dir,
+        "study_area": args.study_area,
+        "bbox": getattr(args, "bbox", None),
+        "output_profile": getattr(args, "output_profile", None),
+    }
+    config.update(extra)
+    return config
+
+
+def run_clip(args):
+    from clip_ntems import (
+        clip_ntems_to_aoi,
+        create_merged_structure_rasters,
+        finalize_merged_structure_rasters,
+        find_ntem_path,
+        get_struct_names,
+    )
+
+    config = make_config(args, ntems=args.ntems, rasin_dir=args.rasin_dir)
+    struct_names = get_struct_names(config) if args.fused_merge else []
+    if struct_names:
+        create_merged_structure_rasters(config, tile_ids=args.tiles)
+    for rasin_name in args.ntems:
+        rasin_path = find_ntem_path(args.rasin_dir, rasin_name)
+        assert rasin_path is not None, f"No .dat found for {rasin_name}"
+        clip_ntems_to_aoi(
+            rasin_name,
+            rasin_path,
+            args.aoi_path,
+            args.out_dir,
+            args.study_area,
+            args.bbox,
+            args.output_profile,
+            tile_ids=args.tiles,
+            pipeline_depth=args.pipeline_depth,
+            block_rows=args.block_rows,
+            chunk_cache_dir=args.chunk_cache_dir,
+            chunk_cache_size=args.chunk_cache_size,
+            fused_struct_names=struct_names or None,
+        )
+    if struct_names:
+        finalize_merged_structure_rasters(config, tile_ids=args.tiles)
+
+
+def run_merge(args):
+    from clip_ntems import merge_structure_rasters
+
+    config = make_config(args, ntems=args.ntems, merge_block_rows=args.block_rows)
+    merge_structure_rasters(config, tile_ids=args.tiles)
+
+
+def run_vri(args):
+    from clip_ntems import crop_vri_shapefile
+
+    crop_vri_shapefile(make_config(args, vri_path=args.vri_path), tile_ids=args.tiles)
+
+
+def run_rasterize(args):
+    from clip_ntems import rasterize_vri_for_tiles
+
+    config = make_config(
+        args,
+        vri_path=args.vri_path,
+        rasin_dir=args.rasin_dir,
+        ntems=[],
+        vri_fields=args.fields,
+        vri_grid_ntem=args.grid_ntem,
+    )
+    rasterize_vri_for_tiles(config, tile_ids=args.tiles)
+
+
+def run_species(args):
+    from crop_species_prob import crop_species_for_tiles
+
+    crop_species_for_tiles(
+        args.aoi_path,
+        args.species_dir,
+        args.out_dir,
+        tile_ids=args.tiles,
+        output_profile=args.output_profile,
+        block_rows=args.block_rows,
+        chunk_cache_dir=args.chunk_cache_dir,
+        chunk_cache_size=args.chunk_cache_size,
+    )
+
+
+def run_mosaic(args):
+    from mosaic_rasters import find_raster_groups, mosaic_rasters
+
+    raster_groups = find_raster_groups(args.input_base)
+    mosaic_rasters(
+        raster_groups,
+        args.output_base,
+        dst_crs=args.dst_crs,
+        output_profile=args.output_profile,
+    )
+
+
+def run_chips(args):
+    from crop_layers import crop_layers
+
+    crop_layers(args.input_dir, args.width, args.height, tile_ids=args.tiles)
+
+
+def run_config(args):
+    from helper.job_graph import has_failures
+    from jobs import run_jobs_from_config
+
+    status = run_jobs_from_config(
+        args.config, args.max_workers, args.executor, args.memory_budget, args.dry_run
+    )
+    if has_failures(status):
+        raise SystemExit(1)
+
+
+def run_enqueue(args):
+    from jobs import enqueue_jobs_from_config
+
+    enqueue_jobs_from_config(
+        args.config, args.queue_dir, args.memory_budget, args.max_workers
+    )
+
+
+def run_worker_processes(args):
+    from helper.work_queue import WorkQueue, run_workers
+
+    run_workers(args.queue_dir, args.max_workers, lease_seconds=args.lease_seconds)
+    # The workers only stop once the queue is drained, so failures are final here
+    if WorkQueue(args.queue_dir, args.lease_seconds).has_failures():
+        raise SystemExit(1)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ntems_clipping")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    clip = subparsers.add_parser("clip", help="Clip and normalize ntems to the AOI tiles")
+    clip.add_argument(
+        "--rasin_dir",
+        type=str,
+        required=True,
+        help="Directory containing the ntems to be clipped",
+    )
+    add_ntems_argument(clip)
+    add_tile_arguments(clip)
+    add_output_profile_argument(clip)
+    clip.add_argument(
+        "--pipeline_depth",
+        type=int,
+        default=0,
+        help="Overlap reading, normalizing and writing of tiles (0 runs serially)",
+    )
+    add_block_rows_argument(clip)
+    add_chunk_cache_arguments(clip)
+    clip.add_argument(
+        "--fused_merge",
+        action="store_true",
+        default=False,
+        help="Also write the structure layers into the merged stack of each tile as they are clipped",
+    )
+    clip.set_defaults(func=run_clip)
+
+    merge = subparsers.add_parser(
+        "merge", help="Merge the normalized structure layers of each tile"
+    )
+    add_ntems_argument(merge)
+    add_tile_arguments(merge)
+    add_output_profile_argument(merge)
+    add_block_rows_argument(merge)
+    merge.set_defaults(func=run_merge)
+
+    vri = subparsers.add_parser("vri", help="Crop the inventory shapefile to each tile")
+    vri.add_argument(
+        "--vri_path", type=str, required=True, help="path to the VRI shapefile"
+    )
+    add_tile_arguments(vri)
+    vri.set_defaults(func=run_vri)
+
+    rasterize = subparsers.add_parser(
+        "rasterize", help="Burn the inventory into rasters on the pixel grid of each tile"
+    )
+    rasterize.add_argument(
+        "--vri_path", type=str, required=True, help="path to the VRI shapefile"
+    )
+    rasterize.add_argument(
+        "--rasin_dir",
+        type=str,
+        required=True,
+        help="Directory of the ntems, the tile grid is taken from --grid_ntem",
+    )
+    rasterize.add_argument(
+        "--grid_ntem",
+        type=str,
+        default="proxies",
+        help="ntem whose tile grid the VRI rasters align to",
+    )
+    rasterize.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        default=[],
+        help="VRI attributes to rasterize besides the polygon id",
+    )
+    add_tile_arguments(rasterize)
+    add_output_profile_argument(rasterize)
+    rasterize.set_defaults(func=run_rasterize)
+
+    species = subparsers.add_parser(
+        "species", help="Crop the species probabilities to each tile"
+    )
+    species.add_argument(
+        "--species_dir",
+        type=str,
+        required=True,
+        help="Directory of the CA_forest species probability rasters",
+    )
+    add_tile_arguments(species, bbox=False)
+    add_output_profile_argument(species)
+    add_block_rows_argument(species)
+    add_chunk_cache_arguments(species)
+    species.set_defaults(func=run_species)
+
+    mosaic = subparsers.add_parser(
+        "mosaic", help="Reproject and mosaic the rasters of every UTM zone"
+    )
+    mosaic.add_argument(
+        "--input_base", type=str, required=True, help="Directory of the UTM zones"
+    )
+    mosaic.add_argument(
+        "--output_base", type=str, required=True, help="Directory of the mosaics"
+    )
+    mosaic.add_argument("--dst_crs", type=str, default="EPSG:3978")
+    add_output_profile_argument(mosaic)
+    mosaic.set_defaults(func=run_mosaic)
+
+    chips = subparsers.add_parser(
+        "chips", help="Crop processed tiles into smaller normalized blocks"
+    )
+    chips.add_argument(
+        "--input_dir", type=str, required=True, help="Directory of the processed tiles"
+    )
+    chips.add_argument("--width", type=int, default=1000, help="Block width")
+    chips.add_argument("--height", type=int, default=1000, help="Block height")
+    chips.add_argument("--tiles", type=int, nargs="+", default=[435])
+    chips.set_defaults(func=run_chips)
+
+    run = subparsers.add_parser("run", help="Run the job graph of a JSON config")
+    run.add_argument("--config", type=str, required=True)
+    run.add_argument("--max_workers", type=int, default=None)
+    run.add_argument(
+        "--executor", type=str, choices=["process", "thread"], default=None
+    )
+    run.add_argument(
+        "--memory_budget",
+        "--memory-budget",
+        type=str,
+        default=None,
+        help="Memory to stay within, e.g. 32G; picks block sizes and worker counts per stage",
+    )
+    run.add_argument(
+        "--dry_run",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Print the memory plan and the number of jobs and exit",
+    )
+    run.set_defaults(func=run_config)
+
+    enqueue = subparsers.add_parser(
+        "enqueue", help="Queue the job graph of a JSON config on a shared filesystem"
+    )
+    enqueue.add_argument("--config", type=str, required=True)
+    enqueue.add_argument("--queue_dir", type=str, required=True)
+    enqueue.add_argument(
+        "--memory_budget",
+        "--memory-budget",
+        type=str,
+        default=None,
+        help="Memory of each node, e.g. 32G; picks block sizes for the queued jobs",
+    )
+    enqueue.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="Workers that will run per node, shared by the memory budget",
+    )
+    enqueue.set_defaults(func=run_enqueue)
+
+    worker = subparsers.add_parser("worker", help="Run workers on a queue directory")
+    worker.add_argument("--queue_dir", type=str, required=True)
+    worker.add_argument("--max_workers", type=int, default=1)
+    worker.add_argument("--lease_seconds", type=int, default=600)
+    worker.set_defaults(func=run_worker_processes)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    setup_logging()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()